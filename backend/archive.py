@@ -0,0 +1,98 @@
+"""Hot/cold split for siswa documents.
+
+Deleting or graduating a siswa only marks it inactive. ``SiswaArchiver``
+periodically moves siswa that have been inactive for longer than
+``archive_after`` into ``siswa_archive``, in batches, so the ``siswa``
+collection (and its active-only partial indexes, see ``indexes.py``) stays the
+size of the current student body. Archived records keep their ``id`` and
+search keys and can still be read; they cannot be edited.
+
+``inactive_since`` records when a siswa was deactivated. Routes set it where
+they know; each archiver pass stamps inactive documents that lack it, so
+their grace period starts then.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+
+from pymongo import ASCENDING, ReplaceOne
+
+from indexes import IndexSpec, QueryShape, register_index
+from search import SEARCH_KEYS_FIELD
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_COLLECTION = "siswa_archive"
+INACTIVE_SINCE = "inactive_since"
+
+register_index(
+    IndexSpec("siswa", [(INACTIVE_SINCE, ASCENDING)], name="inactive_since_inactive",
+              options={"partialFilterExpression": {"is_active": False}}),
+    QueryShape("siswa", {"is_active": False, INACTIVE_SINCE: {"$lt": datetime(2000, 1, 1, tzinfo=timezone.utc)}}),
+)
+register_index(
+    IndexSpec(ARCHIVE_COLLECTION, [("id", ASCENDING)], unique=True, name="id_unique"),
+    QueryShape(ARCHIVE_COLLECTION, {"id": "x"}),
+)
+register_index(
+    IndexSpec(ARCHIVE_COLLECTION, [(SEARCH_KEYS_FIELD, ASCENDING)], name="search_keys"),
+    QueryShape(ARCHIVE_COLLECTION, {SEARCH_KEYS_FIELD: {"$all": ["x"]}}),
+)
+register_index(IndexSpec(ARCHIVE_COLLECTION, [("nis", ASCENDING)], name="nis"))
+register_index(IndexSpec(ARCHIVE_COLLECTION, [("nisn", ASCENDING)], name="nisn"))
+register_index(IndexSpec(ARCHIVE_COLLECTION, [("kelas_id", ASCENDING), ("id", ASCENDING)], name="kelas_id_id"))
+
+
+def activity_fields(is_active: bool) -> Dict[str, Any]:
+    """``inactive_since`` to store alongside a change of ``is_active``."""
+    return {INACTIVE_SINCE: None if is_active else datetime.now(timezone.utc)}
+
+
+class SiswaArchiver:
+    def __init__(self, archive_after: timedelta, interval: float = 6 * 3600, batch_size: int = 500):
+        self.archive_after = archive_after
+        self.interval = interval
+        self.batch_size = batch_size
+        self._task: Optional[asyncio.Task] = None
+
+    async def run_once(self, db) -> Dict[str, int]:
+        now = datetime.now(timezone.utc)
+        stamped = await db.siswa.update_many({"is_active": False, INACTIVE_SINCE: None}, {"$set": {INACTIVE_SINCE: now}})
+        query = {"is_active": False, INACTIVE_SINCE: {"$lt": now - self.archive_after}}
+        archived = 0
+        while True:
+            docs = await db.siswa.find(query, {"_id": 0}).limit(self.batch_size).to_list(self.batch_size)
+            if not docs:
+                break
+            ids = [d["id"] for d in docs]
+            # Copy first, then delete: a crash in between leaves a duplicate, never a loss
+            await db[ARCHIVE_COLLECTION].bulk_write(
+                [ReplaceOne({"id": d["id"]}, {**d, "archived_at": now}, upsert=True) for d in docs], ordered=False,
+            )
+            await db.siswa.delete_many({"id": {"$in": ids}, "is_active": False})
+            # Reactivated since the read: the live document wins
+            survivors = await db.siswa.distinct("id", {"id": {"$in": ids}})
+            if survivors:
+                await db[ARCHIVE_COLLECTION].delete_many({"id": {"$in": survivors}})
+            archived += len(ids) - len(survivors)
+            if len(docs) < self.batch_size:
+                break
+        if archived:
+            logger.info("Archived %d siswa inactive since before %s", archived, (now - self.archive_after).date())
+        return {"stamped": stamped.modified_count, "archived": archived}
+
+    async def _archive_forever(self, db):
+        while True:
+            try:
+                await self.run_once(db)
+            except Exception:
+                logger.exception("Siswa archiving failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self, db):
+        self._task = asyncio.create_task(self._archive_forever(db))
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
@@ -0,0 +1,118 @@
+"""Composite GET requests: several API reads in one HTTP round trip.
+
+Each sub-request is matched against the API router's GET routes and handled
+in process, concurrently, with a copy of the batch request's ASGI scope. The
+principal authenticated for the batch is placed in that scope, so sub-requests
+reuse it instead of authenticating again. Sub-responses must be JSON; their
+bodies are spliced into the combined response as-is, without re-encoding.
+"""
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+import orjson
+from fastapi import Request, Response
+from starlette.routing import Match
+
+logger = logging.getLogger(__name__)
+
+# Scope key carrying the already-authenticated principal into sub-requests
+PRINCIPAL_SCOPE_KEY = "erapor.principal"
+MAX_ITEMS = 20
+FORWARDED_HEADERS = (b"authorization",)
+# Per-item request headers a client may set, and response headers worth returning
+ITEM_REQUEST_HEADERS = ("if-none-match",)
+ITEM_RESPONSE_HEADERS = ("etag", "x-next-cursor")
+
+
+class _NotJSON(Exception):
+    pass
+
+
+def _raised_not_json(exc: BaseException) -> bool:
+    # Streaming responses run in a task group, which wraps the error in an ExceptionGroup
+    return isinstance(exc, _NotJSON) or any(_raised_not_json(e) for e in getattr(exc, "exceptions", ()))
+
+
+def _error(status: int, detail: str) -> Tuple[int, Dict[str, str], bytes]:
+    return status, {}, orjson.dumps({"detail": detail})
+
+
+def _sub_scope(request: Request, path: str, query: str, headers: Dict[str, str], principal: Any) -> Dict[str, Any]:
+    scope = dict(request.scope)
+    forwarded = [(k, v) for k, v in request.scope["headers"] if k in FORWARDED_HEADERS]
+    item_headers = [(k.lower().encode(), v.encode()) for k, v in headers.items() if k.lower() in ITEM_REQUEST_HEADERS]
+    scope.update(
+        method="GET",
+        path=path,
+        raw_path=path.encode(),
+        query_string=query.encode(),
+        headers=[*forwarded, *item_headers, (b"accept", b"application/json")],
+        path_params={},
+    )
+    scope.pop("route", None)
+    scope.pop("endpoint", None)
+    scope[PRINCIPAL_SCOPE_KEY] = principal
+    return scope
+
+
+async def _dispatch(routes: Sequence, scope: Dict[str, Any]) -> Tuple[int, Dict[str, str], bytes]:
+    for route in routes:
+        if "GET" not in getattr(route, "methods", ()):
+            continue
+        match, child_scope = route.matches(scope)
+        if match == Match.FULL:
+            scope.update(child_scope)
+            break
+    else:
+        return _error(404, "Not Found")
+
+    started: Dict[str, Any] = {}
+    body: List[bytes] = []
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        # Streaming responses listen for a disconnect that never comes
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            headers = {k.decode().lower(): v.decode() for k, v in message["headers"]}
+            if message["status"] != 304 and not headers.get("content-type", "").startswith("application/json"):
+                # Streams and files (exports, photos, PDFs) cannot be embedded
+                raise _NotJSON()
+            started.update(status=message["status"], headers=headers)
+        elif message["type"] == "http.response.body":
+            body.append(message.get("body", b""))
+
+    try:
+        await route.handle(scope, receive, send)
+    except Exception as e:
+        if _raised_not_json(e):
+            return _error(415, "Only JSON routes can be batched")
+        logger.exception("Batched request to %s failed", scope["path"])
+        return _error(500, "Internal Server Error")
+    headers = {k: v for k, v in started["headers"].items() if k in ITEM_RESPONSE_HEADERS}
+    return started["status"], headers, b"".join(body) or b"null"
+
+
+async def run_batch(request: Request, routes: Sequence, items: Sequence[Any], principal: Any) -> Response:
+    """Run every item (``id``, ``path``, ``headers``) and combine the results in order."""
+
+    async def run(item) -> Tuple[int, Dict[str, str], bytes]:
+        url = urlsplit(item.path)
+        path = url.path if url.path.startswith("/api/") else "/api/" + url.path.lstrip("/")
+        return await _dispatch(routes, _sub_scope(request, path, url.query, item.headers or {}, principal))
+
+    results = await asyncio.gather(*(run(item) for item in items))
+    parts = []
+    for item, (status, headers, body) in zip(items, results):
+        meta: Dict[str, Optional[Any]] = {"id": item.id, "path": item.path, "status": status, "headers": headers}
+        # The body is already JSON; splice it in rather than decoding and re-encoding it
+        parts.append(orjson.dumps(meta)[:-1] + b',"body":' + body + b"}")
+    return Response(b"[" + b",".join(parts) + b"]", media_type="application/json")
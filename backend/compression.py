@@ -0,0 +1,32 @@
+"""GZip for the JSON API that leaves already-compressed payloads alone.
+
+Starlette's ``GZipMiddleware`` compresses every large response. Photos, PDFs
+and ZIP-based files (archives, XLSX) gain nothing from it, and recompressing a
+206 partial response would make its ``Content-Range`` meaningless.
+"""
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder
+from starlette.types import Message, Receive, Scope, Send
+
+INCOMPRESSIBLE_TYPES = ("image/", "application/zip", "application/pdf", "application/vnd.openxmlformats")
+
+
+class _SelectiveGZipResponder(GZipResponder):
+    async def send_with_gzip(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            content_type = Headers(raw=message["headers"]).get("content-type", "")
+            if message["status"] == 206 or content_type.startswith(INCOMPRESSIBLE_TYPES):
+                # Same path the base class takes for pre-encoded responses: pass through
+                self.initial_message = message
+                self.content_encoding_set = True
+                return
+        await super().send_with_gzip(message)
+
+
+class SelectiveGZipMiddleware(GZipMiddleware):
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and "gzip" in Headers(scope=scope).get("Accept-Encoding", ""):
+            responder = _SelectiveGZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+            await responder(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
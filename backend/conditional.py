@@ -0,0 +1,68 @@
+"""Conditional GETs for master data (jurusan, kelas, mapel, tahun ajaran).
+
+Each collection has a version counter in ``collection_versions`` that write
+routes bump. Versions are cached in process for ``version_ttl`` seconds, so a
+GET with a matching ``If-None-Match`` is answered 304 without touching Mongo,
+and a cache hit on the serialized body skips both the query and the encoding.
+Other workers see a write within ``version_ttl``.
+"""
+import hashlib
+from typing import Awaitable, Callable, Dict, Iterable
+
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+
+from cache import TTLCache
+
+VERSIONS_COLLECTION = "collection_versions"
+# Response headers worth replaying from a cached body
+CACHED_HEADERS = ("x-next-cursor",)
+
+
+class MasterDataCache:
+    def __init__(self, collections: Iterable[str], version_ttl: float = 5.0, max_bodies: int = 256):
+        self.collections = tuple(collections)
+        self._versions = TTLCache(maxsize=1, ttl=version_ttl)
+        self._bodies = TTLCache(maxsize=max_bodies, ttl=24 * 3600)
+
+    async def _load_versions(self, db) -> Dict[str, int]:
+        versions = self._versions.get("all")
+        if versions is None:
+            docs = await db[VERSIONS_COLLECTION].find({"_id": {"$in": list(self.collections)}}).to_list(None)
+            versions = {c: 0 for c in self.collections}
+            versions.update({d["_id"]: d["version"] for d in docs})
+            self._versions.set("all", versions)
+        return versions
+
+    async def bump(self, db, *collections: str):
+        for collection in collections:
+            await db[VERSIONS_COLLECTION].update_one({"_id": collection}, {"$inc": {"version": 1}}, upsert=True)
+        # Reload on the next read, so this worker serves its own write immediately
+        self._versions.clear()
+
+    async def respond(self, request: Request, db, collection: str, build: Callable[[], Awaitable[Response]]) -> Response:
+        version = (await self._load_versions(db))[collection]
+        variant = hashlib.sha1(f"{request.url.query}|{request.headers.get('accept', '')}".encode()).hexdigest()[:12]
+        etag = f'W/"{collection}-{version}-{variant}"'
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+        if etag in (t.strip() for t in request.headers.get("if-none-match", "").split(",")):
+            return Response(status_code=304, headers=headers)
+
+        key = (collection, version, variant)
+        cached = self._bodies.get(key)
+        if cached is not None:
+            body, media_type, extra = cached
+            return Response(content=body, media_type=media_type, headers={**headers, **extra})
+
+        response = await build()
+        if isinstance(response, StreamingResponse):
+            # Streams are never buffered; they still get the validator
+            response.headers.update(headers)
+            return response
+        if not isinstance(response, Response):
+            return response
+        extra = {h: response.headers[h] for h in CACHED_HEADERS if h in response.headers}
+        self._bodies.set(key, (response.body, response.media_type, extra))
+        response.headers.update(headers)
+        return response
@@ -0,0 +1,123 @@
+"""Streaming CSV and XLSX exports.
+
+Rows come straight from Motor cursors and are written in batches, so memory
+use does not grow with the export. Related names (kelas, jurusan, guru) are
+resolved from small maps fetched before the first row. CSV output starts
+flowing with the first batch. XLSX is a ZIP archive that can only be
+finalized once every row is known; openpyxl's write-only mode spools it to a
+temporary file, which is streamed back when complete.
+
+Siswa exports use the same column names ``siswa_import`` reads, so an
+exported roster can be edited and imported again.
+"""
+import csv
+import io
+import tempfile
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+CSV_MEDIA_TYPE = "text/csv; charset=utf-8"
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+BATCH_SIZE = 500
+CHUNK_SIZE = 64 * 1024
+# Spreadsheet apps evaluate cells starting with these as formulas
+_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+@dataclass(frozen=True)
+class Column:
+    header: str
+    value: Callable[[Dict[str, Any]], Any]
+
+
+def field(name: str, header: Optional[str] = None) -> Column:
+    return Column(header or name, lambda doc: doc.get(name))
+
+
+def lookup(name: str, names: Dict[str, str], header: str) -> Column:
+    """A column showing ``names[doc[name]]``, e.g. a kelas name for ``kelas_id``."""
+    return Column(header, lambda doc: names.get(doc.get(name), ""))
+
+
+def _cell(value: Any) -> Any:
+    if value is None:
+        return ""
+    if isinstance(value, str) and value.startswith(_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def _row(doc: Dict[str, Any], columns: List[Column]) -> List[Any]:
+    return [_cell(c.value(doc)) for c in columns]
+
+
+async def chain(*cursors) -> AsyncIterator[Dict[str, Any]]:
+    for cursor in cursors:
+        async for doc in cursor:
+            yield doc
+
+
+async def _batches(docs: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[List[Dict[str, Any]]]:
+    batch = []
+    async for doc in docs:
+        batch.append(doc)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def _csv_stream(docs: AsyncIterator[Dict[str, Any]], columns: List[Column]) -> AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush() -> bytes:
+        data = buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+    # The BOM makes Excel read the file as UTF-8
+    buffer.write("\ufeff")
+    writer.writerow([c.header for c in columns])
+    yield flush()
+    async for batch in _batches(docs):
+        writer.writerows(_row(doc, columns) for doc in batch)
+        yield flush()
+
+
+async def _xlsx_stream(docs: AsyncIterator[Dict[str, Any]], columns: List[Column], title: str) -> AsyncIterator[bytes]:
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title[:31])
+    sheet.append([c.header for c in columns])
+    async for batch in _batches(docs):
+        rows = [_row(doc, columns) for doc in batch]
+        await run_in_threadpool(lambda: [sheet.append(r) for r in rows])
+
+    with tempfile.TemporaryFile() as out:
+        await run_in_threadpool(workbook.save, out)
+        out.seek(0)
+        while True:
+            chunk = await run_in_threadpool(out.read, CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def export_response(docs: AsyncIterator[Dict[str, Any]], columns: List[Column], fmt: str, name: str) -> StreamingResponse:
+    if fmt == "xlsx":
+        body, media_type = _xlsx_stream(docs, columns, name), XLSX_MEDIA_TYPE
+    else:
+        body, media_type = _csv_stream(docs, columns), CSV_MEDIA_TYPE
+    return StreamingResponse(body, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{name}.{fmt}"'})
+
+
+async def name_map(collection, name_field: str, query: Optional[Dict[str, Any]] = None) -> Dict[str, str]:
+    docs = await collection.find(query or {}, {"_id": 0, "id": 1, name_field: 1}).to_list(None)
+    return {d["id"]: d.get(name_field, "") for d in docs}
@@ -0,0 +1,179 @@
+"""Declarative index registry for the E-Rapor collections.
+
+Indexes are applied on app startup (see ``server.py``). The module can also be
+run directly to apply them, or with ``--check`` to run ``explain()`` on every
+registered query shape and fail if any of them still plans a COLLSCAN, or if
+existing duplicates keep a unique index from being built:
+
+    python indexes.py --check
+"""
+import asyncio
+import logging
+import os
+import sys
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+# Duplicate key values reported per unique index
+MAX_REPORTED_DUPLICATES = 20
+
+
+@dataclass(frozen=True)
+class IndexSpec:
+    collection: str
+    keys: List[Tuple[str, int]]
+    unique: bool = False
+    name: Optional[str] = None
+    options: Dict[str, Any] = field(default_factory=dict)
+
+    def to_model(self) -> IndexModel:
+        name = self.name or "_".join(f"{k}_{d}" for k, d in self.keys)
+        return IndexModel(self.keys, name=name, unique=self.unique, **self.options)
+
+
+@dataclass(frozen=True)
+class QueryShape:
+    """A query the API issues, used by the COLLSCAN check."""
+    collection: str
+    filter: Dict[str, Any]
+    sort: Optional[Dict[str, int]] = None
+
+
+# Hot-path siswa indexes only cover active students; see archive.py
+ACTIVE_ONLY = {"partialFilterExpression": {"is_active": True}}
+
+# Every collection is looked up by its application-level ``id``
+ID_COLLECTIONS = ["users", "jurusan", "kelas", "siswa", "guru", "mapel", "tahun_ajaran"]
+
+INDEXES: List[IndexSpec] = [
+    *[IndexSpec(c, [("id", ASCENDING)], unique=True, name="id_unique") for c in ID_COLLECTIONS],
+    IndexSpec("users", [("email", ASCENDING)], unique=True, name="email_unique"),
+    # Trailing id keeps keyset-paginated lists (sorted on id) off an in-memory sort
+    IndexSpec("siswa", [("kelas_id", ASCENDING), ("id", ASCENDING)], name="kelas_id_id_active", options=ACTIVE_ONLY),
+    IndexSpec("mapel", [("jenis", ASCENDING), ("id", ASCENDING)], name="jenis_id"),
+    IndexSpec("kelas", [("wali_kelas_id", ASCENDING)], name="wali_kelas_id"),
+]
+
+QUERY_SHAPES: List[QueryShape] = [
+    *[QueryShape(c, {"id": "x"}) for c in ID_COLLECTIONS],
+    QueryShape("users", {"email": "x@example.com"}),
+    QueryShape("siswa", {"kelas_id": "x", "is_active": True}),
+    QueryShape("kelas", {"wali_kelas_id": "x"}),
+    QueryShape("siswa", {"is_active": True, "id": {"$gt": "x"}}, sort={"id": 1}),
+    QueryShape("siswa", {"kelas_id": "x", "is_active": True, "id": {"$gt": "x"}}, sort={"id": 1}),
+    QueryShape("mapel", {"jenis": "umum"}, sort={"id": 1}),
+]
+
+
+# (collection, name) of indexes replaced by a differently defined one
+RETIRED_INDEXES: List[Tuple[str, str]] = [
+    ("siswa", "kelas_id_is_active_id"),
+    ("siswa", "is_active_id"),
+    # Same key pattern as id_unique, which MongoDB before 5.0 rejects; id_unique serves id-sorted lists
+    ("siswa", "id_active"),
+]
+
+
+def register_index(spec: IndexSpec, *shapes: QueryShape):
+    """Add an index (and the query shapes it serves) to the registry."""
+    INDEXES.append(spec)
+    QUERY_SHAPES.extend(shapes)
+
+
+async def find_duplicates(db, spec: IndexSpec) -> List[Dict[str, Any]]:
+    """Key values of ``spec`` held by more than one document, with those documents' ids."""
+    pipeline = [
+        {"$match": spec.options.get("partialFilterExpression", {})},
+        {"$group": {"_id": {k: f"${k}" for k, _ in spec.keys}, "ids": {"$push": "$id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$limit": MAX_REPORTED_DUPLICATES},
+    ]
+    return [{"key": row["_id"], "ids": row["ids"]} async for row in db[spec.collection].aggregate(pipeline)]
+
+
+async def ensure_indexes(db):
+    """Drop retired indexes and create every registered one. Existing indexes are left untouched."""
+    for collection, name in RETIRED_INDEXES:
+        try:
+            await db[collection].drop_index(name)
+            logger.info("Dropped retired index %s.%s", collection, name)
+        except OperationFailure:
+            pass  # already gone
+
+    # One index per call: createIndexes fails as a unit, so a single bad
+    # index must not take the others on its collection down with it
+    ensured: Dict[str, List[str]] = {}
+    for spec in INDEXES:
+        model = spec.to_model()
+        try:
+            ensured.setdefault(spec.collection, []).extend(await db[spec.collection].create_indexes([model]))
+        except Exception as e:
+            # A conflicting definition or duplicate data must not keep the API down
+            logger.error("Could not create index %s.%s: %s", spec.collection, model.document["name"], e)
+            if spec.unique and getattr(e, "code", None) == DUPLICATE_KEY:
+                for duplicate in await find_duplicates(db, spec):
+                    logger.error("Duplicate %s %s in documents %s", spec.collection, duplicate["key"], ", ".join(map(str, duplicate["ids"])))
+    for collection, names in ensured.items():
+        logger.info("Ensured indexes on %s: %s", collection, ", ".join(names))
+
+
+def _plan_stages(plan: Dict[str, Any]):
+    yield plan.get("stage")
+    if "inputStage" in plan:
+        yield from _plan_stages(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        yield from _plan_stages(child)
+    # Slot-based engine nests the classic plan under queryPlan
+    if "queryPlan" in plan:
+        yield from _plan_stages(plan["queryPlan"])
+
+
+async def check_indexes(db) -> List[QueryShape]:
+    """Explain every registered query shape and return those that COLLSCAN."""
+    failures = []
+    for shape in QUERY_SHAPES:
+        find = {"find": shape.collection, "filter": shape.filter}
+        if shape.sort:
+            find["sort"] = shape.sort
+        explain = await db.command("explain", find, verbosity="queryPlanner")
+        winning_plan = explain["queryPlanner"]["winningPlan"]
+        if "COLLSCAN" in _plan_stages(winning_plan):
+            failures.append(shape)
+    return failures
+
+
+async def _main(check: bool) -> int:
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        await ensure_indexes(db)
+        if not check:
+            return 0
+        failures = await check_indexes(db)
+        for shape in failures:
+            print(f"COLLSCAN: {shape.collection} {shape.filter} sort={shape.sort}")
+        print(f"{len(QUERY_SHAPES) - len(failures)}/{len(QUERY_SHAPES)} query shapes use an index")
+        duplicated = 0
+        for spec in (s for s in INDEXES if s.unique):
+            for duplicate in await find_duplicates(db, spec):
+                duplicated += 1
+                print(f"DUPLICATE: {spec.collection} {duplicate['key']} ids={duplicate['ids']}")
+        return 1 if failures or duplicated else 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(_main("--check" in sys.argv[1:])))
@@ -0,0 +1,211 @@
+"""Per-route latency and Mongo command instrumentation.
+
+``MetricsMiddleware`` times every HTTP request and puts a ``RequestStats`` in a
+contextvar. ``MongoCommandListener`` (registered on the Motor client) appends
+each command to it; Motor copies the context into its executor threads, so
+commands are attributed to the route that issued them. Everything is exposed in
+Prometheus text format by ``render()``, and requests slower than the threshold
+are logged with their query breakdown.
+"""
+import logging
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+DOC_BUCKETS = (0, 1, 10, 100, 1000, 10000)
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Sequence[str], buckets: Sequence[float]):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = Lock()
+
+    def observe(self, value: float, *label_values: str):
+        with self._lock:
+            # Per bucket counts, the overflow bucket, then sum and count
+            series = self._series.setdefault(label_values, [0] * (len(self.buckets) + 3))
+            series[bisect_left(self.buckets, value)] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted(self._series.items())
+        for label_values, series in items:
+            labels = ",".join(f'{k}="{_escape(v)}"' for k, v in zip(self.labels, label_values))
+            sep = "," if labels else ""
+            cumulative = 0
+            for bound, n in zip(self.buckets, series):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels}{sep}le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-2]}")
+            lines.append(f"{self.name}_count{{{labels}}} {series[-1]}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+@dataclass
+class CommandRecord:
+    name: str
+    collection: str
+    duration: float = 0.0
+    documents: int = 0
+    failed: bool = False
+
+
+@dataclass
+class RequestStats:
+    commands: List[CommandRecord] = field(default_factory=list)
+    pending: Dict[int, CommandRecord] = field(default_factory=dict)
+
+
+_request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ["method", "route", "status"], LATENCY_BUCKETS)
+mongo_commands_per_request = Histogram(
+    "mongo_commands_per_request", "Mongo commands issued per HTTP request", ["method", "route"], COUNT_BUCKETS)
+mongo_time_per_request = Histogram(
+    "mongo_time_per_request_seconds", "Time spent in Mongo per HTTP request", ["method", "route"], LATENCY_BUCKETS)
+mongo_documents_per_request = Histogram(
+    "mongo_documents_per_request", "Documents returned by Mongo per HTTP request", ["method", "route"], DOC_BUCKETS)
+mongo_command_duration = Histogram(
+    "mongo_command_duration_seconds", "Mongo command latency", ["command", "collection"], LATENCY_BUCKETS)
+
+HISTOGRAMS = [
+    http_request_duration,
+    mongo_commands_per_request,
+    mongo_time_per_request,
+    mongo_documents_per_request,
+    mongo_command_duration,
+]
+
+# Extra exporters (e.g. password hashing stats) returning Prometheus text lines
+_collectors: List[Callable[[], List[str]]] = []
+
+
+def register_collector(collector: Callable[[], List[str]]):
+    _collectors.append(collector)
+
+
+def render() -> str:
+    lines: List[str] = []
+    for histogram in HISTOGRAMS:
+        lines += histogram.render()
+    for collector in _collectors:
+        lines += collector()
+    return "\n".join(lines) + "\n"
+
+
+def _documents_in(reply) -> int:
+    cursor = reply.get("cursor")
+    if isinstance(cursor, dict):
+        return len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+    if "value" in reply:
+        return 1 if reply["value"] else 0
+    if "values" in reply:
+        return len(reply["values"])
+    return reply.get("n", 0) if isinstance(reply.get("n"), int) else 0
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    def started(self, event):
+        stats = _request_stats.get()
+        if stats is None:
+            return
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            # getMore names its collection separately
+            collection = event.command.get("collection")
+        record = CommandRecord(event.command_name, collection if isinstance(collection, str) else "")
+        stats.pending[event.request_id] = record
+
+    def _finish(self, event, failed: bool):
+        duration = event.duration_micros / 1e6
+        stats = _request_stats.get()
+        record = stats.pending.pop(event.request_id, None) if stats else None
+        if record is None:
+            mongo_command_duration.observe(duration, event.command_name, "")
+            return
+        record.duration = duration
+        record.failed = failed
+        if not failed:
+            record.documents = _documents_in(event.reply)
+        stats.commands.append(record)
+        mongo_command_duration.observe(duration, record.name, record.collection)
+
+    def succeeded(self, event):
+        self._finish(event, failed=False)
+
+    def failed(self, event):
+        self._finish(event, failed=True)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency and Mongo usage per route template."""
+
+    def __init__(self, app, slow_request_seconds: float = 0.5):
+        self.app = app
+        self.slow_request_seconds = slow_request_seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.perf_counter() - started
+            _request_stats.reset(token)
+            self._record(scope, stats, status["code"], duration)
+
+    def _record(self, scope, stats: RequestStats, status: int, duration: float):
+        route = scope.get("route")
+        # Route templates keep label cardinality bounded; unmatched paths share one label
+        path = getattr(route, "path", None) or "unmatched"
+        method = scope["method"]
+        mongo_time = sum(c.duration for c in stats.commands)
+        documents = sum(c.documents for c in stats.commands)
+
+        http_request_duration.observe(duration, method, path, str(status))
+        mongo_commands_per_request.observe(len(stats.commands), method, path)
+        mongo_time_per_request.observe(mongo_time, method, path)
+        mongo_documents_per_request.observe(documents, method, path)
+
+        if duration >= self.slow_request_seconds:
+            breakdown = "; ".join(
+                f"{c.name} {c.collection} {c.duration * 1000:.1f}ms {c.documents} docs{' FAILED' if c.failed else ''}"
+                for c in stats.commands
+            )
+            logger.warning(
+                "Slow request %s %s %.0fms status=%s mongo=%d (%.0fms): %s",
+                method, path, duration * 1000, status, len(stats.commands), mongo_time * 1000, breakdown or "no queries",
+            )
@@ -0,0 +1,73 @@
+"""Grade (nilai) storage.
+
+One document per siswa x mapel x tahun ajaran. Teachers submit a whole class
+for one mapel at a time; the submission is checked against the class roster
+with a single query and written with one unordered ``bulk_write`` of upserts.
+"""
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List
+
+from pymongo import ASCENDING, UpdateOne
+
+from indexes import IndexSpec, QueryShape, register_index
+
+register_index(
+    IndexSpec("nilai", [("id", ASCENDING)], unique=True, name="id_unique"),
+    QueryShape("nilai", {"id": "x"}),
+)
+# The upsert key; also serves the per-siswa reads rapor generation makes
+register_index(
+    IndexSpec("nilai", [("siswa_id", ASCENDING), ("mapel_id", ASCENDING), ("tahun_ajaran_id", ASCENDING)],
+              unique=True, name="siswa_mapel_tahun_unique"),
+    QueryShape("nilai", {"siswa_id": {"$in": ["x"]}, "tahun_ajaran_id": "x"}),
+)
+register_index(
+    IndexSpec("nilai", [("tahun_ajaran_id", ASCENDING), ("kelas_id", ASCENDING), ("mapel_id", ASCENDING), ("id", ASCENDING)],
+              name="tahun_kelas_mapel_id"),
+    QueryShape("nilai", {"tahun_ajaran_id": "x", "kelas_id": "x", "mapel_id": "x", "id": {"$gt": "x"}}, sort={"id": 1}),
+)
+
+
+async def save_bulk(db, kelas_id: str, mapel_id: str, tahun_ajaran_id: str, entries: Iterable[Any], updated_by: str) -> Dict[str, Any]:
+    """Upsert one grade per entry (``siswa_id``, ``nilai``, ``deskripsi``).
+
+    Entries for siswa who are not active members of ``kelas_id`` are rejected;
+    the rest are written in one round trip.
+    """
+    entries = list(entries)
+    requested = [e.siswa_id for e in entries]
+    enrolled = set(await db.siswa.distinct("id", {"kelas_id": kelas_id, "is_active": True, "id": {"$in": requested}}))
+
+    now = datetime.now(timezone.utc)
+    ops: List[UpdateOne] = []
+    rejected: List[Dict[str, str]] = []
+    seen = set()
+    for entry in entries:
+        if entry.siswa_id in seen:
+            rejected.append({"siswa_id": entry.siswa_id, "error": "Duplicate siswa in submission"})
+            continue
+        seen.add(entry.siswa_id)
+        if entry.siswa_id not in enrolled:
+            rejected.append({"siswa_id": entry.siswa_id, "error": "Siswa is not an active member of this kelas"})
+            continue
+        ops.append(UpdateOne(
+            {"siswa_id": entry.siswa_id, "mapel_id": mapel_id, "tahun_ajaran_id": tahun_ajaran_id},
+            {
+                "$set": {
+                    "kelas_id": kelas_id,
+                    "nilai": entry.nilai,
+                    "deskripsi": entry.deskripsi,
+                    "updated_at": now,
+                    "updated_by": updated_by,
+                },
+                "$setOnInsert": {"id": str(uuid.uuid4())},
+            },
+            upsert=True,
+        ))
+
+    inserted = updated = 0
+    if ops:
+        result = await db.nilai.bulk_write(ops, ordered=False)
+        inserted, updated = result.upserted_count, result.matched_count
+    return {"inserted": inserted, "updated": updated, "rejected": rejected}
@@ -0,0 +1,79 @@
+"""Keyset pagination and NDJSON streaming for list endpoints.
+
+Pages are ordered by the unique, indexed ``id`` field. A full page sets the
+``X-Next-Cursor`` response header; pass it back as ``after`` to get the next
+page. Clients sending ``Accept: application/x-ndjson`` instead receive one JSON
+document per line, streamed straight from the Motor cursor. ``fields=a,b``
+limits the response (and the Mongo projection) to those fields.
+
+``transform`` lets a route add derived, per-request fields (e.g. signed photo
+URLs) to each document on its way out.
+"""
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional, Type
+
+from fastapi import Query, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+import serialization
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+SORT_FIELD = "id"
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+@dataclass
+class PageParams:
+    after: Optional[str] = None
+    limit: Optional[int] = None
+    fields: Optional[str] = None
+
+
+def page_params(
+    after: Optional[str] = Query(None, description="Cursor from the previous page's X-Next-Cursor header"),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return"),
+) -> PageParams:
+    return PageParams(after=after, limit=limit, fields=fields)
+
+
+def wants_ndjson(request: Request) -> bool:
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def keyset_query(query: Dict[str, Any], after: Optional[str]) -> Dict[str, Any]:
+    if after is None:
+        return query
+    return {**query, SORT_FIELD: {"$gt": after}}
+
+
+Transform = Callable[[Dict[str, Any]], Dict[str, Any]]
+
+
+async def _ndjson_lines(cursor, model: Type[BaseModel], fields, transform: Optional[Transform]):
+    async for doc in cursor:
+        yield serialization.ndjson_line(model, transform(doc) if transform else doc, fields)
+
+
+async def paginate(request: Request, collection, query: Dict[str, Any], model: Type[BaseModel], page: PageParams,
+                   transform: Optional[Transform] = None):
+    """Return one page of ``collection`` matching ``query``, or stream it as NDJSON."""
+    fields = serialization.parse_fields(model, page.fields)
+    projection = serialization.projection_for(model, fields)
+    cursor = collection.find(keyset_query(query, page.after), projection).sort(SORT_FIELD, 1)
+
+    if wants_ndjson(request):
+        # Without an explicit limit the stream runs to the end of the collection
+        if page.limit:
+            cursor = cursor.limit(page.limit)
+        return StreamingResponse(_ndjson_lines(cursor, model, fields, transform), media_type=NDJSON_MEDIA_TYPE)
+
+    limit = page.limit or DEFAULT_PAGE_SIZE
+    docs = await cursor.limit(limit).to_list(limit)
+    if transform:
+        docs = [transform(doc) for doc in docs]
+    headers = {NEXT_CURSOR_HEADER: docs[-1][SORT_FIELD]} if len(docs) == limit else None
+    return serialization.json_response(serialization.trusted(model, docs, fields), headers=headers)
@@ -0,0 +1,263 @@
+"""Content-addressed student photo store.
+
+Uploaded photos are decoded once, re-encoded as JPEG (EXIF stripped, longest
+side capped) and written next to a thumbnail generated at the same time.
+Files are named by the SHA-256 of the upload, so identical uploads share
+storage and a stored photo never changes. ``Siswa.foto`` holds only the URL
+of the photo (``/api/foto/<digest>``), which keeps siswa documents and list
+payloads small. Downloads support Range requests and are cacheable forever.
+
+Fetching that path needs the usual Bearer token, which an ``<img src>`` cannot
+send. ``PhotoSigner`` issues absolute, HMAC-signed URLs that expire instead;
+``GET /api/siswa/{id}/foto`` hands them out, and siswa lists carry a signed
+``foto_thumb_url`` for every stored photo. Expiry is rounded to whole
+windows, so the same photo keeps the same URL (and browser cache entry) for a
+while.
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import io
+import logging
+import os
+import re
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional, Tuple
+from urllib.parse import urlencode
+
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+URL_PREFIX = "/api/foto/"
+MEDIA_TYPE = "image/jpeg"
+MAX_UPLOAD_BYTES = 5 * 1024 * 1024
+MAX_SIDE = 1024
+THUMB_SIDE = 160
+VARIANTS = ("full", "thumb")
+CHUNK_SIZE = 64 * 1024
+MIGRATION_BATCH_SIZE = 100
+# Content hashes never change, so a client may keep a photo indefinitely
+CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+_DIGEST = re.compile(r"^[0-9a-f]{64}$")
+# How base64 of a JPEG, PNG, GIF or WebP file starts; bare base64 of anything else is not a photo
+_IMAGE_BASE64_PREFIXES = ("/9j/", "iVBORw0KGgo", "R0lGOD", "UklGR")
+
+
+class PhotoError(ValueError):
+    pass
+
+
+def url_for(digest: str) -> str:
+    return f"{URL_PREFIX}{digest}"
+
+
+def is_reference(value: Optional[str]) -> bool:
+    return bool(value) and value.startswith(URL_PREFIX) and bool(_DIGEST.match(value[len(URL_PREFIX):]))
+
+
+class PhotoSigner:
+    def __init__(self, secret: str, ttl: int = 3600):
+        # Derived so a photo signature can never double as anything else signed with the secret
+        self.key = hmac.new(secret.encode(), b"foto-url", hashlib.sha256).digest()
+        self.ttl = ttl
+
+    def _signature(self, digest: str, variant: str, expires: int) -> str:
+        return hmac.new(self.key, f"{digest}:{variant}:{expires}".encode(), hashlib.sha256).hexdigest()
+
+    def url(self, base_url: str, digest: str, variant: str = "full") -> Tuple[str, int]:
+        """Absolute signed URL of a stored photo, valid for ``ttl`` to ``2 * ttl`` seconds; returns (url, expires)."""
+        expires = (int(time.time()) // self.ttl + 2) * self.ttl
+        query = urlencode({"size": variant, "expires": expires, "sig": self._signature(digest, variant, expires)})
+        return f"{base_url.rstrip('/')}{url_for(digest)}?{query}", expires
+
+    def thumb_url(self, base_url: str, foto: Optional[str]) -> Optional[str]:
+        """Thumbnail URL for a ``foto`` value: signed for stored photos, external URLs as they are."""
+        if not foto or not is_reference(foto):
+            return foto
+        return self.url(base_url, foto[len(URL_PREFIX):], "thumb")[0]
+
+    def verify(self, digest: str, variant: str, expires: Optional[int], sig: Optional[str]) -> bool:
+        if expires is None or not sig or expires < time.time():
+            return False
+        return hmac.compare_digest(sig, self._signature(digest, variant, expires))
+
+
+def _encode(image, side: int) -> bytes:
+    image = image.copy()
+    image.thumbnail((side, side))
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=85, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+class PhotoStore:
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def path_for(self, digest: str, variant: str = "full") -> Path:
+        return self.root / digest[:2] / f"{digest}.{variant}.jpg"
+
+    def exists(self, digest: str) -> bool:
+        return self.path_for(digest, "thumb").exists()
+
+    def _write(self, path: Path, data: bytes):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".part")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def save(self, data: bytes) -> str:
+        """Store ``data`` and its thumbnail; returns the digest. Blocking."""
+        from PIL import Image, ImageOps, UnidentifiedImageError
+
+        if len(data) > MAX_UPLOAD_BYTES:
+            raise PhotoError(f"Photo is larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+        digest = hashlib.sha256(data).hexdigest()
+        if self.exists(digest):
+            return digest
+        try:
+            image = Image.open(io.BytesIO(data))
+            image = ImageOps.exif_transpose(image).convert("RGB")
+        except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+            raise PhotoError(f"Not a valid image: {e}")
+        self._write(self.path_for(digest, "full"), _encode(image, MAX_SIDE))
+        # Written last: its presence marks the photo complete
+        self._write(self.path_for(digest, "thumb"), _encode(image, THUMB_SIDE))
+        return digest
+
+    async def save_async(self, data: bytes) -> str:
+        try:
+            return await run_in_threadpool(self.save, data)
+        except PhotoError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+
+
+def decode_inline(value: str) -> Optional[bytes]:
+    """Bytes of a base64 (optionally data: URL) photo, as previously stored in ``foto``.
+
+    None when ``value`` is something else, e.g. an external image URL: those
+    are kept as they are.
+    """
+    if value.startswith("data:image/"):
+        value = value.partition(",")[2]
+    elif not value.startswith(_IMAGE_BASE64_PREFIXES):
+        return None
+    try:
+        return base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        raise PhotoError("foto is not valid base64 image data")
+
+
+async def store_inline(store: PhotoStore, value: str) -> str:
+    """``value``, or the URL of the stored photo when it is inline image data. Raises PhotoError."""
+    data = None if is_reference(value) else decode_inline(value)
+    if data is None:
+        return value
+    return url_for(await run_in_threadpool(store.save, data))
+
+
+async def resolve_foto(store: PhotoStore, value: Optional[str]) -> Optional[str]:
+    """Normalize a client-supplied ``foto``: inline image data is moved into the store."""
+    if not value:
+        return None
+    try:
+        return await store_inline(store, value)
+    except PhotoError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Inclusive byte range of a single-range ``Range`` header; None serves the whole file."""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start_s, _, end_s = header[len("bytes="):].strip().partition("-")
+    try:
+        if start_s:
+            start, end = int(start_s), int(end_s) if end_s else size - 1
+        else:
+            start, end = max(0, size - int(end_s)), size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    return start, min(end, size - 1)
+
+
+def _read_chunks(path: Path, start: int, length: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+async def _stream(path: Path, start: int, length: int):
+    chunks = _read_chunks(path, start, length)
+    while True:
+        chunk = await run_in_threadpool(next, chunks, None)
+        if chunk is None:
+            break
+        yield chunk
+
+
+def photo_response(request: Request, store: PhotoStore, digest: str, variant: str) -> Response:
+    if not _DIGEST.match(digest) or variant not in VARIANTS:
+        raise HTTPException(status_code=404, detail="Foto not found")
+    path = store.path_for(digest, variant)
+    try:
+        size = path.stat().st_size
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Foto not found")
+
+    etag = f'"{digest[:32]}-{variant}"'
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL, "Accept-Ranges": "bytes"}
+    if etag in (t.strip() for t in request.headers.get("if-none-match", "").split(",")):
+        return Response(status_code=304, headers=headers)
+
+    byte_range = parse_range(request.headers.get("range"), size)
+    if request.headers.get("if-range", etag) != etag:
+        byte_range = None
+    if byte_range is None:
+        start, end, status_code = 0, size - 1, 200
+    else:
+        (start, end), status_code = byte_range, 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    length = end - start + 1
+    headers["Content-Length"] = str(length)
+    return StreamingResponse(_stream(path, start, length), status_code=status_code, media_type=MEDIA_TYPE, headers=headers)
+
+
+async def migrate_inline_photos(db, store: PhotoStore):
+    """Move base64 photos still stored in siswa documents into the store.
+
+    Anything else (external URLs, unreadable data) is left as it is, so this
+    is a single pass rather than a loop until nothing matches.
+    """
+    query = {"foto": {"$type": "string", "$not": re.compile(f"^{re.escape(URL_PREFIX)}")}}
+    cursor = db.siswa.find(query, {"_id": 0, "id": 1, "foto": 1}).batch_size(MIGRATION_BATCH_SIZE)
+    migrated = failed = 0
+    async for doc in cursor:
+        try:
+            data = decode_inline(doc["foto"])
+            if data is None:
+                continue
+            foto = url_for(await run_in_threadpool(store.save, data))
+        except PhotoError as e:
+            logger.warning("Keeping unreadable foto of siswa %s as it is: %s", doc["id"], e)
+            failed += 1
+            continue
+        await db.siswa.update_one({"id": doc["id"], "foto": doc["foto"]}, {"$set": {"foto": foto}, "$inc": {"version": 1}})
+        migrated += 1
+    if migrated or failed:
+        logger.info("Moved %d inline photos to the photo store (%d unreadable)", migrated, failed)
@@ -0,0 +1,368 @@
+"""Report card (rapor) PDF generation.
+
+``render_batch`` turns plain-dict cards into PDFs and runs in a process pool,
+so rendering uses every core and never blocks the event loop. ``RaporJobs``
+drives a batch for one or more kelas as a background task: it reads siswa and
+their grades from Mongo in batches, keeps at most ``max_pending`` render
+batches in flight, and appends the finished PDFs to a ZIP file on disk. Job
+progress is stored in the ``rapor_jobs`` collection so any worker can report
+it; the ZIP itself is served by the worker that produced it.
+
+A job that has made no progress for ``stale_after_seconds`` belonged to a
+worker that died or was restarted mid-job; it is marked failed on startup, or
+when its status is next read.
+"""
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+import re
+import time
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from pymongo import ASCENDING, DESCENDING
+from starlette.concurrency import run_in_threadpool
+
+from indexes import IndexSpec, QueryShape, register_index
+
+logger = logging.getLogger(__name__)
+
+JOBS_COLLECTION = "rapor_jobs"
+ACTIVE_STATUSES = ("queued", "running")
+BATCH_SIZE = 25
+# Lower bounds of each predikat, highest first
+PREDIKAT = ((86, "A"), (71, "B"), (56, "C"), (0, "D"))
+SECTIONS = (
+    ("umum", "A. Muatan Umum"),
+    ("kejuruan", "B. Muatan Kejuruan"),
+    ("p5", "C. Projek Penguatan Profil Pelajar Pancasila"),
+    ("ekstra", "D. Ekstrakurikuler"),
+)
+
+register_index(
+    IndexSpec(JOBS_COLLECTION, [("id", ASCENDING)], unique=True, name="id_unique"),
+    QueryShape(JOBS_COLLECTION, {"id": "x"}),
+)
+register_index(IndexSpec(JOBS_COLLECTION, [("created_at", DESCENDING)], name="created_at"))
+
+Card = Dict[str, Any]
+Rendered = Tuple[str, Optional[bytes], Optional[str]]
+
+
+def predikat(nilai: float) -> str:
+    for bound, letter in PREDIKAT:
+        if nilai >= bound:
+            return letter
+    return PREDIKAT[-1][1]
+
+
+def _safe(name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", name).strip("_") or "rapor"
+
+
+def filename_for(card: Card) -> str:
+    siswa = card["siswa"]
+    return f"{_safe(card['kelas'])}/{_safe(siswa['nis'])}_{_safe(siswa['nama_lengkap'])}.pdf"
+
+
+def build_card(siswa: Dict[str, Any], kelas: Dict[str, Any], context: Dict[str, Any], grades: List[Dict[str, Any]]) -> Card:
+    """Everything one PDF needs, as plain (picklable) data."""
+    mapel_map = context["mapel"]
+    rows = []
+    for grade in grades:
+        mapel = mapel_map.get(grade["mapel_id"])
+        if mapel is None:
+            continue
+        rows.append({
+            "jenis": mapel["jenis"],
+            "kode_mapel": mapel["kode_mapel"],
+            "nama_mapel": mapel["nama_mapel"],
+            "nilai": grade["nilai"],
+            "deskripsi": grade.get("deskripsi") or "",
+        })
+    rows.sort(key=lambda r: r["kode_mapel"])
+    return {
+        "sekolah": context["sekolah"],
+        "tahun": context["tahun"],
+        "semester": context["semester"],
+        "kelas": kelas["nama_kelas"],
+        "jurusan": context["jurusan"].get(kelas.get("jurusan_id"), ""),
+        "wali_kelas": context["wali"].get(kelas.get("wali_kelas_id"), ""),
+        "siswa": {k: siswa.get(k) or "" for k in ("nis", "nisn", "nama_lengkap")},
+        "nilai": rows,
+    }
+
+
+def render_rapor(card: Card) -> bytes:
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.lib.units import cm
+    from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+    styles = getSampleStyleSheet()
+    small = styles["BodyText"].clone("small", fontSize=8, leading=10)
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4, leftMargin=2 * cm, rightMargin=2 * cm, topMargin=1.5 * cm, bottomMargin=1.5 * cm,
+                            title=f"Rapor {card['siswa']['nama_lengkap']}")
+    siswa = card["siswa"]
+    story = [
+        Paragraph("LAPORAN HASIL BELAJAR", styles["Title"]),
+        Paragraph(card["sekolah"], styles["Heading3"]),
+        Table(
+            [
+                ["Nama", siswa["nama_lengkap"], "Kelas", card["kelas"]],
+                ["NIS / NISN", f"{siswa['nis']} / {siswa['nisn']}", "Tahun Ajaran", card["tahun"]],
+                ["Jurusan", card["jurusan"], "Semester", card["semester"].capitalize()],
+            ],
+            colWidths=[3 * cm, 6 * cm, 3 * cm, 5 * cm],
+            style=[("FONTSIZE", (0, 0), (-1, -1), 9)],
+        ),
+        Spacer(1, 0.5 * cm),
+    ]
+
+    for jenis, title in SECTIONS:
+        rows = [r for r in card["nilai"] if r["jenis"] == jenis]
+        if not rows:
+            continue
+        story.append(Paragraph(title, styles["Heading4"]))
+        data = [["No", "Mata Pelajaran", "Nilai", "Predikat", "Capaian Kompetensi"]]
+        for i, r in enumerate(rows, start=1):
+            data.append([i, r["nama_mapel"], f"{r['nilai']:g}", predikat(r["nilai"]), Paragraph(r["deskripsi"], small)])
+        table = Table(data, colWidths=[1 * cm, 5 * cm, 1.5 * cm, 1.8 * cm, 7.7 * cm], repeatRows=1)
+        table.setStyle(TableStyle([
+            ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
+            ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
+            ("FONTSIZE", (0, 0), (-1, -1), 9),
+            ("VALIGN", (0, 0), (-1, -1), "TOP"),
+            ("ALIGN", (2, 1), (3, -1), "CENTER"),
+        ]))
+        story += [table, Spacer(1, 0.4 * cm)]
+
+    if not card["nilai"]:
+        story.append(Paragraph("Belum ada nilai untuk semester ini.", styles["BodyText"]))
+    story += [Spacer(1, 1.5 * cm), Paragraph(f"Wali Kelas<br/><br/><br/><br/>{card['wali_kelas'] or '-'}", styles["BodyText"])]
+    doc.build(story)
+    return buffer.getvalue()
+
+
+def render_batch(cards: List[Card]) -> List[Rendered]:
+    """Runs in a worker process; one bad card does not fail the batch."""
+    rendered = []
+    for card in cards:
+        try:
+            rendered.append((filename_for(card), render_rapor(card), None))
+        except Exception as e:
+            rendered.append((filename_for(card), None, f"{type(e).__name__}: {e}"))
+    return rendered
+
+
+async def load_context(db, tahun_ajaran: Dict[str, Any], kelas_list: List[Dict[str, Any]], sekolah: str) -> Dict[str, Any]:
+    """Lookup maps shared by every card in a job, fetched once."""
+    mapel = await db.mapel.find({}, {"_id": 0, "id": 1, "kode_mapel": 1, "nama_mapel": 1, "jenis": 1}).to_list(None)
+    jurusan = await db.jurusan.find({}, {"_id": 0, "id": 1, "nama_jurusan": 1}).to_list(None)
+    wali_ids = list({k["wali_kelas_id"] for k in kelas_list if k.get("wali_kelas_id")})
+    walis = await db.users.find({"id": {"$in": wali_ids}}, {"_id": 0, "id": 1, "name": 1}).to_list(None) if wali_ids else []
+    return {
+        "sekolah": sekolah,
+        "tahun": tahun_ajaran["tahun"],
+        "semester": tahun_ajaran["semester"],
+        "mapel": {m["id"]: m for m in mapel},
+        "jurusan": {j["id"]: j["nama_jurusan"] for j in jurusan},
+        "wali": {w["id"]: w["name"] for w in walis},
+    }
+
+
+async def cards_for(db, siswa_batch: List[Dict[str, Any]], kelas: Dict[str, Any], context: Dict[str, Any], tahun_ajaran_id: str) -> List[Card]:
+    ids = [s["id"] for s in siswa_batch]
+    grades: Dict[str, List[Dict[str, Any]]] = {i: [] for i in ids}
+    async for grade in db.nilai.find({"siswa_id": {"$in": ids}, "tahun_ajaran_id": tahun_ajaran_id},
+                                     {"_id": 0, "siswa_id": 1, "mapel_id": 1, "nilai": 1, "deskripsi": 1}):
+        grades[grade["siswa_id"]].append(grade)
+    return [build_card(s, kelas, context, grades[s["id"]]) for s in siswa_batch]
+
+
+SISWA_FIELDS = {"_id": 0, "id": 1, "nis": 1, "nisn": 1, "nama_lengkap": 1}
+
+
+class RaporJobs:
+    def __init__(self, output_dir: Path, sekolah: str = "", max_workers: Optional[int] = None, retention_seconds: float = 24 * 3600,
+                 stale_after_seconds: float = 15 * 60):
+        self.output_dir = Path(output_dir)
+        self.sekolah = sekolah
+        self.max_workers = max_workers or os.cpu_count() or 1
+        # Enough queued batches to keep every worker busy while results are written
+        self.max_pending = self.max_workers * 2
+        self.retention_seconds = retention_seconds
+        # Running jobs record progress after every batch, far more often than this
+        self.stale_after_seconds = stale_after_seconds
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn: forking a process that holds Motor's threads and sockets is unsafe
+            self._executor = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    async def render_one(self, card: Card) -> bytes:
+        (_, pdf, error), = await asyncio.get_running_loop().run_in_executor(self.executor, render_batch, [card])
+        if pdf is None:
+            raise RuntimeError(error)
+        return pdf
+
+    def path_for(self, job_id: str) -> Path:
+        return self.output_dir / f"{job_id}.zip"
+
+    def _stale(self) -> Dict[str, Any]:
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.stale_after_seconds)
+        return {"status": {"$in": list(ACTIVE_STATUSES)}, "updated_at": {"$lt": cutoff}}
+
+    def _stale_failure(self) -> Dict[str, Any]:
+        return {"$set": {"status": "failed", "error": "Interrupted: the worker running it stopped", "updated_at": datetime.now(timezone.utc)}}
+
+    async def fail_stale(self, db) -> int:
+        """Mark queued/running jobs that stopped making progress as failed."""
+        result = await db[JOBS_COLLECTION].update_many(self._stale(), self._stale_failure())
+        if result.modified_count:
+            logger.warning("Marked %d interrupted rapor jobs as failed", result.modified_count)
+        return result.modified_count
+
+    async def get(self, db, job_id: str) -> Optional[Dict[str, Any]]:
+        job = await db[JOBS_COLLECTION].find_one({"id": job_id}, {"_id": 0})
+        if job and job["status"] in ACTIVE_STATUSES:
+            failed = await db[JOBS_COLLECTION].update_one({"id": job_id, **self._stale()}, self._stale_failure())
+            if failed.modified_count:
+                job = await db[JOBS_COLLECTION].find_one({"id": job_id}, {"_id": 0})
+        return job
+
+    async def start(self, db, tahun_ajaran: Dict[str, Any], kelas_list: List[Dict[str, Any]], requested_by: str) -> Dict[str, Any]:
+        kelas_ids = [k["id"] for k in kelas_list]
+        total = await db.siswa.count_documents({"kelas_id": {"$in": kelas_ids}, "is_active": True})
+        now = datetime.now(timezone.utc)
+        job = {
+            "id": str(uuid.uuid4()),
+            "status": "queued",
+            "tahun_ajaran_id": tahun_ajaran["id"],
+            "kelas_ids": kelas_ids,
+            "requested_by": requested_by,
+            "total": total,
+            "done": 0,
+            "failed": 0,
+            "errors": [],
+            "created_at": now,
+            "updated_at": now,
+        }
+        await db[JOBS_COLLECTION].insert_one(dict(job))
+        task = asyncio.create_task(self._run(db, job, tahun_ajaran, kelas_list))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    async def _update(self, db, job_id: str, fields: Dict[str, Any], inc: Optional[Dict[str, int]] = None, errors: Optional[List[str]] = None):
+        update: Dict[str, Any] = {"$set": {**fields, "updated_at": datetime.now(timezone.utc)}}
+        if inc:
+            update["$inc"] = inc
+        if errors:
+            update["$push"] = {"errors": {"$each": errors, "$slice": 100}}
+        await db[JOBS_COLLECTION].update_one({"id": job_id}, update)
+
+    async def _run(self, db, job: Dict[str, Any], tahun_ajaran: Dict[str, Any], kelas_list: List[Dict[str, Any]]):
+        job_id = job["id"]
+        final_path = self.path_for(job_id)
+        part_path = final_path.with_suffix(".part")
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        pending: Set[asyncio.Future] = set()
+        archive: Optional[zipfile.ZipFile] = None
+
+        async def drain(until: int):
+            nonlocal pending
+            while len(pending) > until:
+                finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in finished:
+                    results = future.result()
+                    # PDFs are already compressed; store them as-is
+                    await run_in_threadpool(_write_entries, archive, results)
+                    errors = [f"{name}: {error}" for name, pdf, error in results if pdf is None]
+                    await self._update(db, job_id, {}, inc={"done": len(results) - len(errors), "failed": len(errors)}, errors=errors)
+
+        try:
+            await run_in_threadpool(self._prepare_output)
+            archive = await run_in_threadpool(zipfile.ZipFile, part_path, "w", zipfile.ZIP_STORED)
+            await self._update(db, job_id, {"status": "running"})
+            context = await load_context(db, tahun_ajaran, kelas_list, self.sekolah)
+
+            for kelas in kelas_list:
+                batch: List[Dict[str, Any]] = []
+                cursor = db.siswa.find({"kelas_id": kelas["id"], "is_active": True}, SISWA_FIELDS).sort("nama_lengkap", 1)
+                async for siswa in cursor:
+                    batch.append(siswa)
+                    if len(batch) < BATCH_SIZE:
+                        continue
+                    await drain(self.max_pending - 1)
+                    cards = await cards_for(db, batch, kelas, context, tahun_ajaran["id"])
+                    pending.add(loop.run_in_executor(self.executor, render_batch, cards))
+                    batch = []
+                if batch:
+                    await drain(self.max_pending - 1)
+                    cards = await cards_for(db, batch, kelas, context, tahun_ajaran["id"])
+                    pending.add(loop.run_in_executor(self.executor, render_batch, cards))
+            await drain(0)
+
+            await run_in_threadpool(archive.close)
+            archive = None
+            os.replace(part_path, final_path)
+            elapsed = time.perf_counter() - started
+            await self._update(db, job_id, {"status": "done", "elapsed_seconds": round(elapsed, 1)})
+            logger.info("Rapor job %s finished: %d siswa in %.1fs", job_id, job["total"], elapsed)
+        except (Exception, asyncio.CancelledError) as e:
+            cancelled = isinstance(e, asyncio.CancelledError)
+            if cancelled:
+                logger.warning("Rapor job %s cancelled", job_id)
+            else:
+                logger.exception("Rapor job %s failed", job_id)
+            if isinstance(e, BrokenProcessPool):
+                # A crashed worker breaks the whole pool; start a fresh one for the next job
+                self._executor = None
+            for future in pending:
+                future.cancel()
+            if archive is not None:
+                archive.close()
+            part_path.unlink(missing_ok=True)
+            error = "Cancelled: the server shut down" if cancelled else f"{type(e).__name__}: {e}"
+            await self._update(db, job_id, {"status": "failed", "error": error})
+            if cancelled:
+                raise
+
+    def _prepare_output(self):
+        """Create the output directory and drop archives past retention."""
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        cutoff = time.time() - self.retention_seconds
+        for path in self.output_dir.glob("*.zip"):
+            if path.stat().st_mtime < cutoff:
+                path.unlink(missing_ok=True)
+
+    async def shutdown(self, timeout: float = 5.0):
+        """Cancel running jobs, give them ``timeout`` seconds to record it, then stop the pool."""
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def _write_entries(archive: zipfile.ZipFile, results: List[Rendered]):
+    for name, pdf, _ in results:
+        if pdf is not None:
+            archive.writestr(name, pdf)
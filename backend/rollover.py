@@ -0,0 +1,212 @@
+"""Academic-year rollover: promote every class and switch the active tahun ajaran.
+
+Each kelas maps to the kelas one tingkatan up in the same jurusan with the same
+name suffix ("X RPL 1" -> "XI RPL 1"); students in XII graduate and are marked
+inactive. Optionally each wali kelas moves up with their class, and the wali
+of a graduating XII class takes over the incoming X class.
+
+``plan_rollover`` only reads and returns what would change, so the same plan
+serves as a dry run. ``apply_rollover`` writes the whole plan in one
+transaction (a few ``bulk_write`` calls), so a rollover either happens
+completely or not at all. Transactions need a replica set or mongos.
+"""
+import uuid
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from pymongo import UpdateMany, UpdateOne
+from pymongo.errors import OperationFailure
+
+from archive import activity_fields
+
+TINGKATAN = ("X", "XI", "XII")
+ROLLOVERS_COLLECTION = "rollovers"
+# Mongo's "Transaction numbers are only allowed on a replica set member or mongos"
+ILLEGAL_OPERATION = 20
+
+
+class TransactionsUnsupported(Exception):
+    pass
+
+
+class RolloverConflict(Exception):
+    pass
+
+
+@dataclass
+class KelasMove:
+    kelas_id: str
+    nama_kelas: str
+    tingkatan: str
+    target_id: str
+    target_nama_kelas: str
+    siswa: int
+
+
+@dataclass
+class Graduation:
+    kelas_id: str
+    nama_kelas: str
+    siswa: int
+
+
+@dataclass
+class WaliChange:
+    kelas_id: str
+    nama_kelas: str
+    from_wali_kelas_id: Optional[str]
+    to_wali_kelas_id: Optional[str]
+
+
+@dataclass
+class RolloverPlan:
+    from_tahun_ajaran: Optional[Dict[str, Any]]
+    to_tahun_ajaran: Dict[str, Any]
+    moves: List[KelasMove] = field(default_factory=list)
+    graduations: List[Graduation] = field(default_factory=list)
+    wali_changes: List[WaliChange] = field(default_factory=list)
+    problems: List[str] = field(default_factory=list)
+
+    def as_dict(self) -> Dict[str, Any]:
+        result = asdict(self)
+        result["total_promoted"] = sum(m.siswa for m in self.moves)
+        result["total_graduated"] = sum(g.siswa for g in self.graduations)
+        return result
+
+
+def _suffix(kelas: Dict[str, Any]) -> str:
+    """The part of the class name after its tingkatan, e.g. "RPL 1" for "X RPL 1"."""
+    name = kelas["nama_kelas"].strip()
+    head, _, rest = name.partition(" ")
+    return rest.strip().lower() if head == kelas.get("tingkatan") else name.lower()
+
+
+def _target(kelas: Dict[str, Any], candidates: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    same_suffix = [c for c in candidates if _suffix(c) == _suffix(kelas)]
+    if len(same_suffix) == 1:
+        return same_suffix[0]
+    # A jurusan with a single class at the next level needs no name match
+    return candidates[0] if not same_suffix and len(candidates) == 1 else None
+
+
+async def plan_rollover(db, target: Dict[str, Any], wali_follows_class: bool = False) -> RolloverPlan:
+    current = await db.tahun_ajaran.find_one({"is_active": True}, {"_id": 0})
+    plan = RolloverPlan(from_tahun_ajaran=current, to_tahun_ajaran=target)
+    if target.get("is_active"):
+        plan.problems.append(f"Tahun ajaran {target['tahun']} {target['semester']} is already active")
+    elif current and target["tahun"] == current["tahun"]:
+        # Classes only move up between years; a semester change just activates the target
+        plan.problems.append(
+            f"{target['tahun']} is the current year; switch the semester by activating the tahun ajaran instead of rolling over"
+        )
+    elif current and target["tahun"] < current["tahun"]:
+        plan.problems.append(f"{target['tahun']} is before the current year {current['tahun']}")
+
+    kelas_list = await db.kelas.find({}, {"_id": 0}).to_list(None)
+    counts = {
+        row["_id"]: row["n"]
+        async for row in db.siswa.aggregate([{"$match": {"is_active": True}}, {"$group": {"_id": "$kelas_id", "n": {"$sum": 1}}}])
+    }
+    by_level: Dict[tuple, List[Dict[str, Any]]] = {}
+    for kelas in kelas_list:
+        by_level.setdefault((kelas.get("jurusan_id"), kelas.get("tingkatan")), []).append(kelas)
+
+    new_wali: Dict[str, Optional[str]] = {}
+    for kelas in sorted(kelas_list, key=lambda k: k["nama_kelas"]):
+        tingkatan = kelas.get("tingkatan")
+        siswa = counts.get(kelas["id"], 0)
+        if tingkatan not in TINGKATAN:
+            if siswa:
+                plan.problems.append(f"Kelas {kelas['nama_kelas']} has unknown tingkatan '{tingkatan}'")
+            continue
+        if tingkatan == TINGKATAN[-1]:
+            plan.graduations.append(Graduation(kelas["id"], kelas["nama_kelas"], siswa))
+            # The incoming first-year class inherits the graduating class' wali
+            target_kelas = _target(kelas, by_level.get((kelas.get("jurusan_id"), TINGKATAN[0]), []))
+        else:
+            next_level = TINGKATAN[TINGKATAN.index(tingkatan) + 1]
+            target_kelas = _target(kelas, by_level.get((kelas.get("jurusan_id"), next_level), []))
+            if target_kelas is None:
+                if siswa:
+                    plan.problems.append(f"No {next_level} kelas to promote {kelas['nama_kelas']} into")
+                continue
+            plan.moves.append(KelasMove(kelas["id"], kelas["nama_kelas"], tingkatan, target_kelas["id"], target_kelas["nama_kelas"], siswa))
+        if wali_follows_class and target_kelas is not None:
+            new_wali[target_kelas["id"]] = kelas.get("wali_kelas_id")
+
+    targets = [m.target_id for m in plan.moves]
+    duplicated = {t for t in targets if targets.count(t) > 1}
+    for kelas_id in duplicated:
+        sources = ", ".join(m.nama_kelas for m in plan.moves if m.target_id == kelas_id)
+        plan.problems.append(f"{sources} would all be promoted into the same kelas")
+
+    kelas_by_id = {k["id"]: k for k in kelas_list}
+    for kelas_id, wali in sorted(new_wali.items(), key=lambda item: kelas_by_id[item[0]]["nama_kelas"]):
+        kelas = kelas_by_id[kelas_id]
+        if kelas.get("wali_kelas_id") != wali:
+            plan.wali_changes.append(WaliChange(kelas_id, kelas["nama_kelas"], kelas.get("wali_kelas_id"), wali))
+    return plan
+
+
+def _graduation_ops(plan: RolloverPlan) -> List[UpdateMany]:
+    graduated = {"is_active": False, **activity_fields(False)}
+    return [
+        UpdateMany({"kelas_id": g.kelas_id, "is_active": True}, {"$set": graduated, "$inc": {"version": 1}})
+        for g in plan.graduations
+    ]
+
+
+def _promotion_ops(plan: RolloverPlan) -> List[UpdateMany]:
+    # Applied in order, highest level first: XI must have left for XII before X moves into XI
+    moves = sorted(plan.moves, key=lambda m: TINGKATAN.index(m.tingkatan), reverse=True)
+    return [
+        UpdateMany({"kelas_id": m.kelas_id, "is_active": True}, {"$set": {"kelas_id": m.target_id}, "$inc": {"version": 1}})
+        for m in moves
+    ]
+
+
+async def apply_rollover(db, plan: RolloverPlan, performed_by: str) -> Dict[str, Any]:
+    """Write ``plan`` atomically; returns the stored rollover record."""
+    target_id = plan.to_tahun_ajaran["id"]
+    graduation_ops, promotion_ops = _graduation_ops(plan), _promotion_ops(plan)
+    kelas_ops = [
+        UpdateOne({"id": w.kelas_id}, {"$set": {"wali_kelas_id": w.to_wali_kelas_id}, "$inc": {"version": 1}})
+        for w in plan.wali_changes
+    ]
+    record = {
+        "id": str(uuid.uuid4()),
+        "performed_by": performed_by,
+        "performed_at": datetime.now(timezone.utc),
+        **plan.as_dict(),
+    }
+
+    async def write(session):
+        promoted = graduated = 0
+        # Graduates leave first, so XII is empty before XI moves in
+        if graduation_ops:
+            graduated = (await db.siswa.bulk_write(graduation_ops, ordered=True, session=session)).modified_count
+        if promotion_ops:
+            promoted = (await db.siswa.bulk_write(promotion_ops, ordered=True, session=session)).modified_count
+        if kelas_ops:
+            await db.kelas.bulk_write(kelas_ops, ordered=True, session=session)
+        activated = await db.tahun_ajaran.update_one(
+            {"id": target_id, "is_active": {"$ne": True}}, {"$set": {"is_active": True}, "$inc": {"version": 1}}, session=session,
+        )
+        if activated.modified_count != 1:
+            # Someone else rolled over first; abort everything above
+            raise RolloverConflict("Target tahun ajaran was activated concurrently")
+        await db.tahun_ajaran.update_many(
+            {"id": {"$ne": target_id}, "is_active": True}, {"$set": {"is_active": False}, "$inc": {"version": 1}}, session=session,
+        )
+        record.update(promoted=promoted, graduated=graduated)
+        await db[ROLLOVERS_COLLECTION].insert_one(dict(record), session=session)
+
+    try:
+        async with await db.client.start_session() as session:
+            await session.with_transaction(write)
+    except OperationFailure as e:
+        if e.code == ILLEGAL_OPERATION:
+            raise TransactionsUnsupported("Rollover needs MongoDB transactions (a replica set or mongos)") from e
+        raise
+    return record
@@ -0,0 +1,52 @@
+"""Per-user data scope: which kelas (and mapel) a user's requests may touch.
+
+The scope is resolved once per request (FastAPI caches dependencies within a
+request) and kept across requests in a TTL cache. Routes that change an
+assignment - a kelas' wali, a mapel's guru - invalidate the affected users.
+"""
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from cache import TTLCache
+
+
+@dataclass(frozen=True)
+class DataScope:
+    unrestricted: bool = False
+    kelas_ids: Tuple[str, ...] = ()
+    mapel_ids: Tuple[str, ...] = ()
+
+    def restrict_siswa(self, query: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Narrow a siswa query to what this scope may see; None if that is nothing."""
+        if self.unrestricted:
+            return query
+        requested = query.get("kelas_id")
+        allowed = [k for k in self.kelas_ids if requested is None or k == requested]
+        if not allowed:
+            return None
+        return {**query, "kelas_id": allowed[0] if len(allowed) == 1 else {"$in": allowed}}
+
+
+UNRESTRICTED = DataScope(unrestricted=True)
+
+
+class ScopeResolver:
+    def __init__(self, loader: Callable[[Any, str, str], Awaitable[DataScope]], ttl: float = 300.0, maxsize: int = 4096):
+        self._loader = loader
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def resolve(self, db, user_id: str, role: str) -> DataScope:
+        key = (user_id, role)
+        scope = self._cache.get(key)
+        if scope is None:
+            scope = await self._loader(db, user_id, role)
+            self._cache.set(key, scope)
+        return scope
+
+    def invalidate(self, user_ids: Iterable[Optional[str]]):
+        targets = {u for u in user_ids if u}
+        if targets:
+            self._cache.discard_where(lambda key, _: key[0] in targets)
+
+    def clear(self):
+        self._cache.clear()
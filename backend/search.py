@@ -0,0 +1,144 @@
+"""Indexed student search.
+
+Each siswa document carries a ``search_keys`` array holding every prefix of
+every normalized (lowercased, accent-folded) token of ``nama_lengkap``, plus
+each whole token with a ``WHOLE_TOKEN_MARK`` suffix. A query matches a name
+when each of its tokens is one of those keys, which is a plain multikey index
+lookup. NIS and NISN are matched with anchored prefixes, which Mongo also
+serves from an index.
+
+Candidates are fetched best first (exact NIS/NISN, then whole-word names, then
+prefixes) and ranked in process, so a short prefix matching more than
+``MAX_CANDIDATES`` students cannot crowd out the exact matches.
+"""
+import logging
+import re
+import unicodedata
+from typing import Any, Dict, List, Optional
+
+from pymongo import ASCENDING, UpdateOne
+
+from indexes import IndexSpec, QueryShape, register_index
+
+logger = logging.getLogger(__name__)
+
+SEARCH_KEYS_FIELD = "search_keys"
+# Bumped whenever search_keys() changes, so the backfill recomputes stale keys
+SEARCH_KEYS_VERSION_FIELD = "search_keys_version"
+SEARCH_KEYS_VERSION = 2
+# Cannot occur in a normalized token, so marked keys never collide with prefixes
+WHOLE_TOKEN_MARK = "="
+MAX_PREFIX_LENGTH = 20
+# Upper bound on documents ranked per query; deeper pages are not meaningful
+MAX_CANDIDATES = 500
+BACKFILL_BATCH_SIZE = 500
+# Fields rank() reads from each candidate
+RANK_FIELDS = ["nis", "nisn", "nama_lengkap"]
+
+register_index(
+    IndexSpec("siswa", [(SEARCH_KEYS_FIELD, ASCENDING), ("is_active", ASCENDING)], name="search_keys_is_active"),
+    QueryShape("siswa", {SEARCH_KEYS_FIELD: {"$all": ["x"]}, "is_active": True}),
+)
+# Unique as well: the bulk import upserts on NIS
+register_index(
+    IndexSpec("siswa", [("nis", ASCENDING)], unique=True, name="nis_unique"),
+    QueryShape("siswa", {"nis": {"$regex": "^1"}, "is_active": True}),
+)
+register_index(
+    IndexSpec("siswa", [("nisn", ASCENDING)], name="nisn"),
+    QueryShape("siswa", {"nisn": {"$regex": "^1"}, "is_active": True}),
+)
+
+_NON_WORD = re.compile(r"[^0-9a-z]+")
+
+
+def normalize(text: str) -> str:
+    """Lowercase, strip accents and collapse everything else to single spaces."""
+    decomposed = unicodedata.normalize("NFKD", text)
+    folded = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return _NON_WORD.sub(" ", folded.lower()).strip()
+
+
+def tokenize(text: str) -> List[str]:
+    return normalize(text).split()
+
+
+def search_keys(nama_lengkap: str) -> List[str]:
+    keys = set()
+    for token in tokenize(nama_lengkap):
+        for end in range(1, min(len(token), MAX_PREFIX_LENGTH) + 1):
+            keys.add(token[:end])
+        keys.add(token[:MAX_PREFIX_LENGTH] + WHOLE_TOKEN_MARK)
+    return sorted(keys)
+
+
+def search_fields(siswa: Dict[str, Any]) -> Dict[str, Any]:
+    """Derived fields to store alongside a siswa document."""
+    return {
+        SEARCH_KEYS_FIELD: search_keys(siswa.get("nama_lengkap", "")),
+        SEARCH_KEYS_VERSION_FIELD: SEARCH_KEYS_VERSION,
+    }
+
+
+def build_query(q: str) -> Optional[Dict[str, Any]]:
+    """Mongo filter for ``q``, or None when it has nothing to search on."""
+    tokens = [t[:MAX_PREFIX_LENGTH] for t in tokenize(q)]
+    if not tokens:
+        return None
+    clauses = [{SEARCH_KEYS_FIELD: {"$all": tokens}}]
+    code = q.strip()
+    if code and " " not in code:
+        prefix = "^" + re.escape(code)
+        clauses += [{"nis": {"$regex": prefix}}, {"nisn": {"$regex": prefix}}]
+    return {"$or": clauses} if len(clauses) > 1 else clauses[0]
+
+
+def candidate_queries(q: str) -> List[Dict[str, Any]]:
+    """Filters for ``q`` from the most to the least relevant matches; empty when there is nothing to search on."""
+    prefixes = build_query(q)
+    if prefixes is None:
+        return []
+    queries = []
+    code = q.strip()
+    if " " not in code:
+        queries.append({"$or": [{"nis": code}, {"nisn": code}]})
+    whole = [t[:MAX_PREFIX_LENGTH] + WHOLE_TOKEN_MARK for t in tokenize(q)]
+    queries += [{SEARCH_KEYS_FIELD: {"$all": whole}}, prefixes]
+    return queries
+
+
+def _score(doc: Dict[str, Any], q: str, tokens: List[str]) -> tuple:
+    code = q.strip()
+    if code in (doc.get("nis"), doc.get("nisn")):
+        return (0,)
+    if code and (doc.get("nis", "").startswith(code) or doc.get("nisn", "").startswith(code)):
+        return (1,)
+    name_tokens = tokenize(doc.get("nama_lengkap", ""))
+    whole_words = sum(1 for t in tokens if t in name_tokens)
+    # Query tokens matching the start of the name rank above matches further in
+    leading = sum(1 for a, b in zip(tokens, name_tokens) if b.startswith(a))
+    return (2, -whole_words, -leading, len(name_tokens), normalize(doc.get("nama_lengkap", "")))
+
+
+def rank(docs: List[Dict[str, Any]], q: str) -> List[Dict[str, Any]]:
+    tokens = tokenize(q)
+    return sorted(docs, key=lambda d: _score(d, q, tokens))
+
+
+async def backfill_search_keys(collection):
+    """(Re)compute ``search_keys`` on documents written before the current ``SEARCH_KEYS_VERSION``."""
+    stale = {SEARCH_KEYS_VERSION_FIELD: {"$ne": SEARCH_KEYS_VERSION}}
+    cursor = collection.find(stale, {"_id": 0, "id": 1, "nama_lengkap": 1})
+    batch = []
+    updated = 0
+    async for doc in cursor:
+        batch.append(UpdateOne({"id": doc["id"]}, {"$set": search_fields(doc)}))
+        if len(batch) >= BACKFILL_BATCH_SIZE:
+            await collection.bulk_write(batch, ordered=False)
+            updated += len(batch)
+            batch = []
+    if batch:
+        await collection.bulk_write(batch, ordered=False)
+        updated += len(batch)
+    if updated:
+        logger.info("Backfilled search keys on %d documents in %s", updated, collection.name)
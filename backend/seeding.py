@@ -0,0 +1,148 @@
+"""Declarative, idempotent seed data.
+
+A ``SeedSet`` lists the documents each collection should contain, identified
+by natural keys that are backed by unique indexes. ``apply_seed`` writes each
+collection with one unordered ``bulk_write`` of ``$setOnInsert`` upserts, so
+existing documents are never modified and concurrent runs cannot create
+duplicates. The same engine provisions a new school database:
+
+    python seeding.py <db_name>
+"""
+import asyncio
+import logging
+import os
+import sys
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+
+from pydantic import BaseModel
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from indexes import DUPLICATE_KEY, IndexSpec, register_index
+
+logger = logging.getLogger(__name__)
+
+register_index(IndexSpec("jurusan", [("kode_jurusan", ASCENDING)], unique=True, name="kode_jurusan_unique"))
+register_index(IndexSpec("kelas", [("nama_kelas", ASCENDING)], unique=True, name="nama_kelas_unique"))
+register_index(IndexSpec("mapel", [("kode_mapel", ASCENDING)], unique=True, name="kode_mapel_unique"))
+register_index(IndexSpec("tahun_ajaran", [("tahun", ASCENDING), ("semester", ASCENDING)], unique=True, name="tahun_semester_unique"))
+
+
+@dataclass
+class SeedCollection:
+    collection: str
+    key: Tuple[str, ...]
+    model: Type[BaseModel]
+    docs: List[Dict[str, Any]]
+    # Turns seed docs into model fields, e.g. resolving codes to ids
+    resolve: Optional[Callable[[Any, List[Dict[str, Any]]], Any]] = None
+
+
+@dataclass
+class SeedSet:
+    collections: List[SeedCollection] = field(default_factory=list)
+
+
+async def _apply_collection(db, seed: SeedCollection) -> Dict[str, int]:
+    docs = await seed.resolve(db, seed.docs) if seed.resolve else seed.docs
+    ops = [
+        UpdateOne(
+            {k: doc[k] for k in seed.key},
+            {"$setOnInsert": seed.model(**doc).dict()},
+            upsert=True,
+        )
+        for doc in docs
+    ]
+    if not ops:
+        return {"inserted": 0, "unchanged": 0}
+
+    try:
+        result = await db[seed.collection].bulk_write(ops, ordered=False)
+        inserted = result.upserted_count
+    except BulkWriteError as e:
+        # A concurrent run inserted the same key first; that document is simply unchanged
+        if any(err.get("code") != DUPLICATE_KEY for err in e.details.get("writeErrors", [])):
+            raise
+        inserted = e.details.get("nUpserted", 0)
+    return {"inserted": inserted, "unchanged": len(ops) - inserted}
+
+
+async def apply_seed(db, seed_set: SeedSet) -> Dict[str, Dict[str, int]]:
+    """Apply every collection in order; returns inserted/unchanged counts per collection."""
+    report = {}
+    for seed in seed_set.collections:
+        report[seed.collection] = await _apply_collection(db, seed)
+    return report
+
+
+def default_seed(models: Dict[str, Type[BaseModel]], tahun: str = "2024/2025") -> SeedSet:
+    """The standard SMK jurusan, kelas X-XII, mapel and first tahun ajaran."""
+    jurusan = [
+        {"kode_jurusan": "AKL", "nama_jurusan": "Akuntansi dan Keuangan Lembaga"},
+        {"kode_jurusan": "MP", "nama_jurusan": "Manajemen Perkantoran"},
+        {"kode_jurusan": "RPL", "nama_jurusan": "Rekayasa Perangkat Lunak"},
+        {"kode_jurusan": "TO", "nama_jurusan": "Teknik Otomotif (TSM)"},
+    ]
+    kelas = [
+        {"tingkatan": tingkat, "nama_kelas": f"{tingkat} {j['kode_jurusan']} 1", "kode_jurusan": j["kode_jurusan"]}
+        for tingkat in ["X", "XI", "XII"]
+        for j in jurusan
+    ]
+    mapel = [
+        {"kode_mapel": "PABP", "nama_mapel": "Pendidikan Agama dan Budi Pekerti", "jenis": "umum"},
+        {"kode_mapel": "PPKN", "nama_mapel": "Pendidikan Pancasila dan Kewarganegaraan", "jenis": "umum"},
+        {"kode_mapel": "BINDO", "nama_mapel": "Bahasa Indonesia", "jenis": "umum"},
+        {"kode_mapel": "MAT", "nama_mapel": "Matematika", "jenis": "umum"},
+        {"kode_mapel": "SEJ", "nama_mapel": "Sejarah", "jenis": "umum"},
+        {"kode_mapel": "BING", "nama_mapel": "Bahasa Inggris", "jenis": "umum"},
+        {"kode_mapel": "PJOK", "nama_mapel": "Pendidikan Jasmani, Olahraga, dan Kesehatan", "jenis": "umum"},
+        {"kode_mapel": "AKL1", "nama_mapel": "Akuntansi Dasar", "jenis": "kejuruan"},
+        {"kode_mapel": "MP1", "nama_mapel": "Otomatisasi Tata Kelola Perkantoran", "jenis": "kejuruan"},
+        {"kode_mapel": "RPL1", "nama_mapel": "Pemrograman Dasar", "jenis": "kejuruan"},
+        {"kode_mapel": "TO1", "nama_mapel": "Teknik Kendaraan Ringan", "jenis": "kejuruan"},
+        {"kode_mapel": "P5", "nama_mapel": "Projek P5", "jenis": "p5"},
+        {"kode_mapel": "PRAM", "nama_mapel": "Pramuka", "jenis": "ekstra"},
+        {"kode_mapel": "PMR", "nama_mapel": "Palang Merah Remaja", "jenis": "ekstra"},
+    ]
+    tahun_ajaran = [{"tahun": tahun, "semester": "ganjil", "is_active": True}]
+
+    async def resolve_jurusan_ids(db, docs):
+        kode_list = sorted({d["kode_jurusan"] for d in docs})
+        found = await db.jurusan.find({"kode_jurusan": {"$in": kode_list}}, {"_id": 0, "id": 1, "kode_jurusan": 1}).to_list(None)
+        ids = {j["kode_jurusan"]: j["id"] for j in found}
+        return [{**d, "jurusan_id": ids[d["kode_jurusan"]]} for d in docs if d["kode_jurusan"] in ids]
+
+    return SeedSet([
+        SeedCollection("jurusan", ("kode_jurusan",), models["jurusan"], jurusan),
+        SeedCollection("kelas", ("nama_kelas",), models["kelas"], kelas, resolve=resolve_jurusan_ids),
+        SeedCollection("mapel", ("kode_mapel",), models["mapel"], mapel),
+        SeedCollection("tahun_ajaran", ("tahun", "semester"), models["tahun_ajaran"], tahun_ajaran),
+    ])
+
+
+async def _main(db_name: str):
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    from indexes import ensure_indexes
+    from server import Jurusan, Kelas, Mapel, TahunAjaran
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[db_name]
+    try:
+        await ensure_indexes(db)
+        seed = default_seed({"jurusan": Jurusan, "kelas": Kelas, "mapel": Mapel, "tahun_ajaran": TahunAjaran})
+        for collection, counts in (await apply_seed(db, seed)).items():
+            print(f"{collection}: {counts['inserted']} inserted, {counts['unchanged']} unchanged")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 2:
+        sys.exit("usage: python seeding.py <db_name>")
+    asyncio.run(_main(sys.argv[1]))
@@ -0,0 +1,66 @@
+"""Fast response path for trusted reads.
+
+Documents we wrote ourselves are already valid, so list routes skip building a
+Pydantic model per document (and FastAPI's second pass through
+``response_model``). Instead, the Mongo projection selects exactly the model's
+fields, missing fields get their static defaults, and orjson encodes the result.
+"""
+from typing import Any, Dict, Iterable, List, Optional, Type
+
+import orjson
+from fastapi import HTTPException
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+
+
+def model_field_names(model: Type[BaseModel]) -> List[str]:
+    return list(model.model_fields)
+
+
+def parse_fields(model: Type[BaseModel], fields: Optional[str]) -> Optional[List[str]]:
+    """Validate a ``fields=a,b`` query parameter against ``model``."""
+    if not fields:
+        return None
+    requested = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = sorted(set(requested) - set(model.model_fields))
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    # id is always returned; pagination cursors depend on it
+    return ["id", *[f for f in requested if f != "id"]]
+
+
+def projection_for(model: Type[BaseModel], fields: Optional[List[str]] = None) -> Dict[str, int]:
+    """Inclusion projection of ``fields`` (default: every model field), never Mongo's _id."""
+    return {"_id": 0, **{f: 1 for f in (fields or model_field_names(model))}}
+
+
+_STATIC_DEFAULTS: Dict[type, Dict[str, Any]] = {}
+
+
+def _static_defaults(model: Type[BaseModel]) -> Dict[str, Any]:
+    defaults = _STATIC_DEFAULTS.get(model)
+    if defaults is None:
+        defaults = _STATIC_DEFAULTS[model] = {
+            name: info.default
+            for name, info in model.model_fields.items()
+            if not info.is_required() and info.default_factory is None
+        }
+    return defaults
+
+
+def trusted(model: Type[BaseModel], docs: Iterable[Dict[str, Any]], fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """Fill defaults for fields older documents lack, without validating."""
+    defaults = _static_defaults(model)
+    if fields:
+        defaults = {k: v for k, v in defaults.items() if k in fields}
+    if not defaults:
+        return list(docs)
+    return [{**defaults, **doc} for doc in docs]
+
+
+def ndjson_line(model: Type[BaseModel], doc: Dict[str, Any], fields: Optional[List[str]] = None) -> bytes:
+    return orjson.dumps(trusted(model, [doc], fields)[0]) + b"\n"
+
+
+def json_response(content: Any, headers: Optional[Dict[str, str]] = None) -> ORJSONResponse:
+    return ORJSONResponse(content, headers=headers)
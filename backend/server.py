@@ -1,37 +1,101 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, File, Header, Query, Request, Response, UploadFile, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, ORJSONResponse, PlainTextResponse
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+import asyncio
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type, Union, get_args
 import uuid
 from datetime import datetime, timezone, timedelta
 import jwt
-from passlib.context import CryptContext
 import bcrypt
 
+from cache import TTLCache
+from compression import SelectiveGZipMiddleware
+from hashing import HasherBusy, PasswordHasher
+from indexes import ensure_indexes
+from pagination import NEXT_CURSOR_HEADER, PageParams, page_params, paginate
+import search
+from conditional import MasterDataCache
+import archive
+import batch
+import export
+import metrics
+import nilai
+import photos
+import rapor
+import rollover
+import seeding
+import serialization
+import siswa_import
+from stats import SISWA_BY_KELAS, DashboardCounters
+from scope import UNRESTRICTED, DataScope, ScopeResolver
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[metrics.MongoCommandListener()])
 db = client[os.environ['DB_NAME']]
 
 # Security
 SECRET_KEY = os.environ.get('SECRET_KEY', 'your-secret-key-here-change-in-production')
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+AUTH_CACHE_TTL_SECONDS = float(os.environ.get('AUTH_CACHE_TTL_SECONDS', '60'))
+AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', '4096'))
+
+dashboard_counters = DashboardCounters(
+    cache_ttl=float(os.environ.get('STATS_CACHE_TTL_SECONDS', '10')),
+    reconcile_interval=float(os.environ.get('STATS_RECONCILE_SECONDS', '600')),
+)
+
+# Conditional GET / body cache for rarely-changing master data
+master_data = MasterDataCache(
+    ["jurusan", "kelas", "mapel", "tahun_ajaran"],
+    version_ttl=float(os.environ.get('MASTER_DATA_VERSION_TTL_SECONDS', '5')),
+)
+
+rapor_jobs = rapor.RaporJobs(
+    output_dir=Path(os.environ.get('RAPOR_OUTPUT_DIR', '/tmp/erapor-rapor')),
+    sekolah=os.environ.get('SCHOOL_NAME', 'SMK'),
+    max_workers=int(os.environ['RAPOR_WORKERS']) if os.environ.get('RAPOR_WORKERS') else None,
+    stale_after_seconds=float(os.environ.get('RAPOR_JOB_STALE_SECONDS', '900')),
+)
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+photo_store = photos.PhotoStore(Path(os.environ.get('PHOTO_STORE_DIR', ROOT_DIR / 'storage' / 'foto')))
+photo_signer = photos.PhotoSigner(SECRET_KEY, ttl=int(os.environ.get('PHOTO_URL_TTL_SECONDS', '3600')))
+# Where browsers reach this API; defaults to the host the request came in on
+PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL')
+
+siswa_archiver = archive.SiswaArchiver(
+    archive_after=timedelta(days=float(os.environ.get('SISWA_ARCHIVE_AFTER_DAYS', '180'))),
+    interval=float(os.environ.get('SISWA_ARCHIVE_INTERVAL_SECONDS', '21600')),
+)
+
+password_hasher = PasswordHasher(
+    rounds=int(os.environ.get('BCRYPT_ROUNDS', '12')),
+    max_workers=int(os.environ.get('PASSWORD_HASH_WORKERS', '4')),
+    max_queue=int(os.environ.get('PASSWORD_HASH_MAX_QUEUE', '64')),
+)
 security = HTTPBearer()
+# For routes that also accept another proof of access, e.g. signed photo URLs
+optional_security = HTTPBearer(auto_error=False)
+
+# Verified token -> subject, and subject (email) -> User principal
+token_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL_SECONDS)
+principal_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL_SECONDS)
 
 # Create the main app
-app = FastAPI(title="E-Rapor SMK API", version="1.0.0")
+app = FastAPI(title="E-Rapor SMK API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # Create API router
 api_router = APIRouter(prefix="/api")
@@ -45,6 +109,8 @@ class UserRole:
     GURU_EKSTRA = "guru_ekstra"
     WALI_KELAS = "wali_kelas"
 
+USER_ROLES = {value for name, value in vars(UserRole).items() if not name.startswith("_")}
+
 # Pydantic Models
 class User(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -60,6 +126,11 @@ class UserCreate(BaseModel):
     password: str
     role: str
 
+class UserUpdate(BaseModel):
+    name: Optional[str] = None
+    role: Optional[str] = None
+    is_active: Optional[bool] = None
+
 class UserLogin(BaseModel):
     email: EmailStr
     password: str
@@ -80,6 +151,13 @@ class Kelas(BaseModel):
     jurusan_id: str
     nama_kelas: str
     wali_kelas_id: Optional[str] = None
+    version: int = 0
+
+class KelasUpdate(BaseModel):
+    tingkatan: Optional[str] = None
+    jurusan_id: Optional[str] = None
+    nama_kelas: Optional[str] = None
+    wali_kelas_id: Optional[str] = None
 
 class Siswa(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -89,14 +167,31 @@ class Siswa(BaseModel):
     jk: str  # L/P
     tanggal_lahir: str
     kelas_id: str
-    foto: Optional[str] = None
+    foto: Optional[str] = None  # /api/foto/<digest> (GET /siswa/{id}/foto signs it) or an external URL; see photos.py
     is_active: bool = True
+    version: int = 0
+
+class SiswaUpdate(BaseModel):
+    nis: Optional[str] = None
+    nisn: Optional[str] = None
+    nama_lengkap: Optional[str] = None
+    jk: Optional[str] = None
+    tanggal_lahir: Optional[str] = None
+    kelas_id: Optional[str] = None
+    foto: Optional[str] = None
+    is_active: Optional[bool] = None
 
 class Guru(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
     nama: str
     nuptk: Optional[str] = None
+    version: int = 0
+
+class GuruUpdate(BaseModel):
+    user_id: Optional[str] = None
+    nama: Optional[str] = None
+    nuptk: Optional[str] = None
 
 class Mapel(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -104,19 +199,133 @@ class Mapel(BaseModel):
     nama_mapel: str
     jenis: str  # umum, kejuruan, p5, ekstra
     guru_id: Optional[str] = None
+    version: int = 0
+
+class MapelUpdate(BaseModel):
+    kode_mapel: Optional[str] = None
+    nama_mapel: Optional[str] = None
+    jenis: Optional[str] = None
+    guru_id: Optional[str] = None
 
 class TahunAjaran(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     tahun: str  # 2024/2025
     semester: str  # ganjil, genap
     is_active: bool = False
+    version: int = 0
+
+class TahunAjaranUpdate(BaseModel):
+    tahun: Optional[str] = None
+    semester: Optional[str] = None
+    is_active: Optional[bool] = None
+
+class Nilai(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    siswa_id: str
+    mapel_id: str
+    tahun_ajaran_id: str
+    kelas_id: str
+    nilai: float = Field(ge=0, le=100)
+    deskripsi: Optional[str] = None
+
+class NilaiEntry(BaseModel):
+    siswa_id: str
+    nilai: float = Field(ge=0, le=100)
+    deskripsi: Optional[str] = None
+
+class NilaiBulk(BaseModel):
+    kelas_id: str
+    mapel_id: str
+    tahun_ajaran_id: str
+    nilai: List[NilaiEntry]
+
+class BatchItem(BaseModel):
+    id: Optional[str] = None  # echoed back, to match results to requests
+    path: str  # e.g. "/api/kelas?limit=50" or "kelas?limit=50"
+    headers: Optional[Dict[str, str]] = None  # only If-None-Match is honoured
+
+class BatchRequest(BaseModel):
+    requests: List[BatchItem] = Field(min_length=1, max_length=batch.MAX_ITEMS)
+
+class RolloverRequest(BaseModel):
+    dry_run: bool = False
+    wali_follows_class: bool = False  # each wali moves up with their class
+
+class RaporJobRequest(BaseModel):
+    tahun_ajaran_id: Optional[str] = None  # defaults to the active tahun ajaran
+    kelas_id: Optional[str] = None  # whole school when omitted
+
+# Optimistic concurrency
+def parse_if_match(if_match: Optional[str]) -> Optional[int]:
+    """Version expected by an If-Match header; None when the client did not send one."""
+    if if_match is None or if_match.strip() == "*":
+        return None
+    try:
+        return int(if_match.strip().removeprefix("W/").strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid If-Match header")
+
+def set_etag(response: Response, doc: Dict[str, Any]):
+    response.headers["ETag"] = f'"{doc.get("version", 0)}"'
+
+def _accepts_none(annotation: Any) -> bool:
+    return annotation is Any or annotation is None or type(None) in get_args(annotation)
+
+def partial_fields(update: BaseModel, model: Type[BaseModel]) -> Dict[str, Any]:
+    """Fields sent in a PATCH body, rejecting nulls for fields the full model does not allow to be null."""
+    fields = update.dict(exclude_unset=True)
+    for name, value in fields.items():
+        if value is None and not _accepts_none(model.model_fields[name].annotation):
+            raise HTTPException(status_code=422, detail=f"{name} cannot be null")
+    return fields
+
+def duplicate_key_conflict(error: DuplicateKeyError, label: str) -> HTTPException:
+    """409 naming the unique field(s) a write collided on."""
+    key = (error.details or {}).get("keyValue") or {}
+    clash = " and ".join(f"{field} '{value}'" for field, value in key.items())
+    return HTTPException(status_code=409, detail=f"{label} with {clash} already exists" if clash else f"{label} already exists")
+
+async def update_document(collection, doc_id: str, fields: Dict[str, Any], if_match: Optional[str], label: str) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Apply ``fields`` and bump the version in one round trip; returns (before, after)."""
+    query = {"id": doc_id}
+    expected = parse_if_match(if_match)
+    if expected is not None:
+        # Documents written before versioning have no version field
+        query["version"] = expected if expected else {"$in": [0, None]}
+    
+    update = {"$inc": {"version": 1}}
+    if fields:
+        update["$set"] = fields
+    try:
+        before = await collection.find_one_and_update(query, update, projection={"_id": 0}, return_document=ReturnDocument.BEFORE)
+    except DuplicateKeyError as e:
+        raise duplicate_key_conflict(e, label)
+    if before is None:
+        if expected is not None and await collection.count_documents({"id": doc_id}, limit=1):
+            raise HTTPException(status_code=412, detail=f"{label} was modified by another user")
+        raise HTTPException(status_code=404, detail=f"{label} not found")
+    return before, {**before, **fields, "version": before.get("version", 0) + 1}
 
 # Authentication functions
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+def _hasher_busy():
+    return HTTPException(
+        status_code=503,
+        detail="Server busy, please retry",
+        headers={"Retry-After": "1"},
+    )
+
+async def verify_password(plain_password, hashed_password):
+    """Return (is_valid, new_hash); new_hash is set when the stored hash needs upgrading."""
+    try:
+        return await password_hasher.verify_and_update(plain_password, hashed_password)
+    except HasherBusy:
+        raise _hasher_busy()
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    try:
+        return await password_hasher.hash(password)
+    except HasherBusy:
+        raise _hasher_busy()
 
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -125,20 +334,38 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
+def invalidate_principal(email: str):
+    """Forget the cached principal so the next request reloads it from Mongo."""
+    principal_cache.pop(email)
+
+async def get_current_user(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    # Sub-requests of /batch carry the principal the batch already authenticated
+    principal = request.scope.get(batch.PRINCIPAL_SCOPE_KEY)
+    if principal is not None:
+        return principal
+    token = credentials.credentials
+    email = token_cache.get(token)
+    if email is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            email = payload.get("sub")
+            if email is None:
+                raise HTTPException(status_code=401, detail="Invalid token")
+        except jwt.PyJWTError:
             raise HTTPException(status_code=401, detail="Invalid token")
-    except jwt.PyJWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    
-    user = await db.users.find_one({"email": email})
+        # Never keep a token cached past its own expiry
+        token_cache.set(token, email, ttl=payload["exp"] - datetime.now(timezone.utc).timestamp())
+
+    user = principal_cache.get(email)
     if user is None:
-        raise HTTPException(status_code=401, detail="User not found")
-    return User(**user)
+        user_doc = await db.users.find_one({"email": email})
+        if user_doc is None:
+            raise HTTPException(status_code=401, detail="User not found")
+        user = User(**user_doc)
+        principal_cache.set(email, user)
+    if not user.is_active:
+        raise HTTPException(status_code=401, detail="User is inactive")
+    return user
 
 def require_role(allowed_roles: List[str]):
     def role_checker(current_user: User = Depends(get_current_user)):
@@ -147,6 +374,25 @@ def require_role(allowed_roles: List[str]):
         return current_user
     return role_checker
 
+# Data scope
+async def load_data_scope(db, user_id: str, role: str) -> DataScope:
+    if role == UserRole.ADMIN:
+        return UNRESTRICTED
+    if role == UserRole.WALI_KELAS:
+        kelas_ids = await db.kelas.distinct("id", {"wali_kelas_id": user_id})
+        return DataScope(kelas_ids=tuple(sorted(kelas_ids)))
+    if role in (UserRole.GURU_MAPEL, UserRole.GURU_EKSTRA):
+        guru_ids = await db.guru.distinct("id", {"user_id": user_id})
+        mapel_ids = await db.mapel.distinct("id", {"guru_id": {"$in": guru_ids}}) if guru_ids else []
+        return DataScope(mapel_ids=tuple(sorted(mapel_ids)))
+    return DataScope()
+
+scope_resolver = ScopeResolver(load_data_scope, ttl=float(os.environ.get('SCOPE_CACHE_TTL_SECONDS', '300')))
+
+async def get_data_scope(current_user: User = Depends(get_current_user)) -> DataScope:
+    """Kelas/mapel the current user may access, resolved once per request"""
+    return await scope_resolver.resolve(db, current_user.id, current_user.role)
+
 # Authentication Routes
 @api_router.post("/auth/register", response_model=User)
 async def register(user_data: UserCreate):
@@ -156,22 +402,35 @@ async def register(user_data: UserCreate):
         raise HTTPException(status_code=400, detail="Email already registered")
     
     # Hash password
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await get_password_hash(user_data.password)
     
     # Create user
     user_dict = user_data.dict()
     user_dict["password"] = hashed_password
     user_obj = User(**{k: v for k, v in user_dict.items() if k != "password"})
     
-    # Store in database
-    await db.users.insert_one({**user_obj.dict(), "password": hashed_password})
+    # Store in database; email_unique catches a concurrent registration the check above missed
+    try:
+        await db.users.insert_one({**user_obj.dict(), "password": hashed_password})
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
     return user_obj
 
 @api_router.post("/auth/login", response_model=Token)
 async def login(user_credentials: UserLogin):
     user = await db.users.find_one({"email": user_credentials.email})
-    if not user or not verify_password(user_credentials.password, user["password"]):
+    if not user:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    
+    is_valid, new_hash = await verify_password(user_credentials.password, user["password"])
+    if not is_valid:
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    # Same answer get_current_user gives, rather than a token that fails on first use
+    if not user.get("is_active", True):
+        raise HTTPException(status_code=401, detail="User is inactive")
+    if new_hash:
+        # Hash cost changed since this password was stored
+        await db.users.update_one({"id": user["id"]}, {"$set": {"password": new_hash}})
     
     access_token = create_access_token(data={"sub": user["email"]})
     user_obj = User(**user)
@@ -181,341 +440,667 @@ async def login(user_credentials: UserLogin):
 async def get_current_user_info(current_user: User = Depends(get_current_user)):
     return current_user
 
+# User management (Admin only)
+@api_router.put("/users/{user_id}", response_model=User)
+async def update_user(user_id: str, user_data: UserUpdate, current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    update = partial_fields(user_data, User)
+    if "role" in update and update["role"] not in USER_ROLES:
+        raise HTTPException(status_code=422, detail=f"role must be one of: {', '.join(sorted(USER_ROLES))}")
+    
+    if update:
+        updated_user = await db.users.find_one_and_update(
+            {"id": user_id}, {"$set": update}, projection={"_id": 0, "password": 0}, return_document=ReturnDocument.AFTER,
+        )
+    else:
+        updated_user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
+    if not updated_user:
+        raise HTTPException(status_code=404, detail="User not found")
+    # Role or active-flag changes must take effect on the very next request
+    invalidate_principal(updated_user["email"])
+    return User(**updated_user)
+
+# System Routes (Admin only)
+@api_router.get("/system/metrics")
+async def get_system_metrics(current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    return {"password_hashing": password_hasher.metrics()}
+
 # Dashboard Routes
 @api_router.get("/dashboard/stats")
-async def get_dashboard_stats(current_user: User = Depends(get_current_user)):
+async def get_dashboard_stats(current_user: User = Depends(get_current_user), scope: DataScope = Depends(get_data_scope)):
     """Get dashboard statistics based on user role"""
     stats = {}
     
     if current_user.role == UserRole.ADMIN:
         # Admin can see all statistics
-        stats["total_siswa"] = await db.siswa.count_documents({"is_active": True})
-        stats["total_guru"] = await db.guru.count_documents({})
-        stats["total_kelas"] = await db.kelas.count_documents({})
-        stats["total_mapel"] = await db.mapel.count_documents({})
+        counters = await dashboard_counters.get(db)
+        stats["total_siswa"] = counters.get("siswa", 0)
+        stats["total_guru"] = counters.get("guru", 0)
+        stats["total_kelas"] = counters.get("kelas", 0)
+        stats["total_mapel"] = counters.get("mapel", 0)
     elif current_user.role == UserRole.WALI_KELAS:
         # Wali kelas can see their class statistics
-        wali_kelas = await db.kelas.find_one({"wali_kelas_id": current_user.id})
-        if wali_kelas:
-            stats["siswa_di_kelas"] = await db.siswa.count_documents({"kelas_id": wali_kelas["id"], "is_active": True})
+        if scope.kelas_ids:
+            by_kelas = (await dashboard_counters.get(db)).get(SISWA_BY_KELAS, {})
+            stats["siswa_di_kelas"] = sum(by_kelas.get(k, 0) for k in scope.kelas_ids)
     
     return stats
 
 # Jurusan Routes (Admin only)
 @api_router.get("/jurusan", response_model=List[Jurusan])
-async def get_jurusan(current_user: User = Depends(require_role([UserRole.ADMIN]))):
-    jurusan_list = await db.jurusan.find().to_list(1000)
-    return [Jurusan(**j) for j in jurusan_list]
+async def get_jurusan(request: Request, page: PageParams = Depends(page_params), current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    return await master_data.respond(request, db, "jurusan", lambda: paginate(request, db.jurusan, {}, Jurusan, page))
 
 @api_router.post("/jurusan", response_model=Jurusan)
 async def create_jurusan(jurusan: Jurusan, current_user: User = Depends(require_role([UserRole.ADMIN]))):
-    await db.jurusan.insert_one(jurusan.dict())
+    try:
+        await db.jurusan.insert_one(jurusan.dict())
+    except DuplicateKeyError as e:
+        raise duplicate_key_conflict(e, "Jurusan")
+    await master_data.bump(db, "jurusan")
     return jurusan
 
 # Kelas Routes (Admin only)
 @api_router.get("/kelas", response_model=List[Kelas])
-async def get_kelas(current_user: User = Depends(require_role([UserRole.ADMIN]))):
-    kelas_list = await db.kelas.find().to_list(1000)
-    return [Kelas(**k) for k in kelas_list]
+async def get_kelas(request: Request, page: PageParams = Depends(page_params), current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    return await master_data.respond(request, db, "kelas", lambda: paginate(request, db.kelas, {}, Kelas, page))
 
 @api_router.post("/kelas", response_model=Kelas)
 async def create_kelas(kelas: Kelas, current_user: User = Depends(require_role([UserRole.ADMIN]))):
-    await db.kelas.insert_one(kelas.dict())
+    try:
+        await db.kelas.insert_one(kelas.dict())
+    except DuplicateKeyError as e:
+        raise duplicate_key_conflict(e, "Kelas")
+    await master_data.bump(db, "kelas")
+    await dashboard_counters.increment(db, {"kelas": 1})
+    scope_resolver.invalidate([kelas.wali_kelas_id])
     return kelas
 
 # Siswa Routes (Admin only for CRUD)
+def public_base_url(request: Request) -> str:
+    return PUBLIC_BASE_URL or str(request.base_url)
+
+def with_foto_urls(request: Request) -> Callable[[Dict[str, Any]], Dict[str, Any]]:
+    """Adds a signed ``foto_thumb_url`` next to each siswa's ``foto``, usable as <img src>."""
+    base_url = public_base_url(request)
+
+    def add(siswa: Dict[str, Any]) -> Dict[str, Any]:
+        if "foto" in siswa:
+            siswa["foto_thumb_url"] = photo_signer.thumb_url(base_url, siswa["foto"])
+        return siswa
+    return add
+
 @api_router.get("/siswa", response_model=List[Siswa])
-async def get_siswa(current_user: User = Depends(require_role([UserRole.ADMIN, UserRole.WALI_KELAS]))):
-    if current_user.role == UserRole.WALI_KELAS:
-        # Wali kelas can only see their students
-        wali_kelas = await db.kelas.find_one({"wali_kelas_id": current_user.id})
-        if wali_kelas:
-            siswa_list = await db.siswa.find({"kelas_id": wali_kelas["id"], "is_active": True}).to_list(1000)
-        else:
-            siswa_list = []
-    else:
-        # Admin can see all students
-        siswa_list = await db.siswa.find({"is_active": True}).to_list(1000)
+async def get_siswa(request: Request, page: PageParams = Depends(page_params), current_user: User = Depends(require_role([UserRole.ADMIN, UserRole.WALI_KELAS])), scope: DataScope = Depends(get_data_scope)):
+    # Admin sees all students, wali kelas only their own
+    query = scope.restrict_siswa({"is_active": True})
+    if query is None:
+        return []
     
-    return [Siswa(**s) for s in siswa_list]
+    return await paginate(request, db.siswa, query, Siswa, page, transform=with_foto_urls(request))
 
 @api_router.post("/siswa", response_model=Siswa)
 async def create_siswa(siswa: Siswa, current_user: User = Depends(require_role([UserRole.ADMIN]))):
-    await db.siswa.insert_one(siswa.dict())
+    siswa.foto = await photos.resolve_foto(photo_store, siswa.foto)
+    siswa_dict = siswa.dict()
+    try:
+        await db.siswa.insert_one({**siswa_dict, **search.search_fields(siswa_dict)})
+    except DuplicateKeyError as e:
+        raise duplicate_key_conflict(e, "Siswa")
+    await dashboard_counters.siswa_changed(db, None, siswa_dict)
     return siswa
 
+@api_router.post("/siswa/import")
+async def import_siswa(file: UploadFile = File(...), current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    """Bulk create or update siswa (keyed on NIS) from a CSV or XLSX file"""
+    report = await siswa_import.import_siswa(db, file, Siswa, photo_store)
+    # Rows may move between classes or be reactivated; recount rather than track each one
+    await dashboard_counters.reconcile(db)
+    return report
+
+# Exports (declared before the /{id} routes)
+ExportFormat = Query("csv", pattern="^(csv|xlsx)$")
+
+@api_router.get("/siswa/export")
+async def export_siswa(kelas_id: Optional[str] = None, format: str = ExportFormat, current_user: User = Depends(require_role([UserRole.ADMIN, UserRole.WALI_KELAS])), scope: DataScope = Depends(get_data_scope)):
+    """Active siswa as CSV/XLSX, grouped by kelas; the columns siswa import accepts"""
+    query = scope.restrict_siswa({"is_active": True, **({"kelas_id": kelas_id} if kelas_id else {})})
+    if query is None:
+        raise HTTPException(status_code=403, detail="Insufficient permissions")
+    kelas_query = {"id": query["kelas_id"]} if "kelas_id" in query else {}
+    kelas_list = await db.kelas.find(kelas_query, {"_id": 0, "id": 1, "nama_kelas": 1, "jurusan_id": 1}).sort("nama_kelas", 1).to_list(None)
+    jurusan = await export.name_map(db.jurusan, "nama_jurusan")
+    kelas_names = {k["id"]: k["nama_kelas"] for k in kelas_list}
+    kelas_jurusan = {k["id"]: jurusan.get(k.get("jurusan_id"), "") for k in kelas_list}
+
+    projection = {"_id": 0, "nis": 1, "nisn": 1, "nama_lengkap": 1, "jk": 1, "tanggal_lahir": 1, "kelas_id": 1}
+    # One small, name-sorted cursor per kelas instead of sorting the whole school
+    cursors = [db.siswa.find({"kelas_id": k["id"], "is_active": True}, projection).sort("nama_lengkap", 1) for k in kelas_list]
+    if not kelas_query:
+        cursors.append(db.siswa.find({"is_active": True, "kelas_id": {"$nin": list(kelas_names)}}, projection))
+    columns = [
+        *[export.field(f) for f in ("nis", "nisn", "nama_lengkap", "jk", "tanggal_lahir")],
+        export.lookup("kelas_id", kelas_names, "kelas"),
+        export.lookup("kelas_id", kelas_jurusan, "jurusan"),
+    ]
+    name = f"siswa-{kelas_names[kelas_id]}" if kelas_id in kelas_names else "siswa"
+    return export.export_response(export.chain(*cursors), columns, format, name.replace(" ", "_"))
+
+@api_router.get("/guru/export")
+async def export_guru(format: str = ExportFormat, current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    emails = await export.name_map(db.users, "email")
+    columns = [export.field("nama"), export.field("nuptk"), export.lookup("user_id", emails, "email")]
+    return export.export_response(db.guru.find({}, {"_id": 0}).sort("nama", 1), columns, format, "guru")
+
+@api_router.get("/mapel/export")
+async def export_mapel(format: str = ExportFormat, current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    guru = await export.name_map(db.guru, "nama")
+    columns = [*[export.field(f) for f in ("kode_mapel", "nama_mapel", "jenis")], export.lookup("guru_id", guru, "guru")]
+    return export.export_response(db.mapel.find({}, {"_id": 0}).sort("kode_mapel", 1), columns, format, "mapel")
+
+@api_router.get("/kelas/export")
+async def export_kelas(format: str = ExportFormat, current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    jurusan = await export.name_map(db.jurusan, "nama_jurusan")
+    walis = await export.name_map(db.users, "name", {"role": UserRole.WALI_KELAS})
+    siswa_by_kelas = (await dashboard_counters.get(db)).get(SISWA_BY_KELAS, {})
+    columns = [
+        export.field("nama_kelas"),
+        export.field("tingkatan"),
+        export.lookup("jurusan_id", jurusan, "jurusan"),
+        export.lookup("wali_kelas_id", walis, "wali_kelas"),
+        export.Column("jumlah_siswa", lambda k: siswa_by_kelas.get(k["id"], 0)),
+    ]
+    return export.export_response(db.kelas.find({}, {"_id": 0}).sort("nama_kelas", 1), columns, format, "kelas")
+
+# Search and Filter endpoints
+# Declared before /siswa/{siswa_id} so "search" is not taken for an id
+@api_router.get("/siswa/search", response_model=List[Siswa])
+async def search_siswa(
+    request: Request,
+    q: Optional[str] = None,
+    kelas_id: Optional[str] = None, 
+    jurusan_id: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    fields: Optional[str] = None,
+    include_archived: bool = Query(False, description="Also return inactive and archived siswa"),
+    current_user: User = Depends(require_role([UserRole.ADMIN, UserRole.WALI_KELAS])),
+    scope: DataScope = Depends(get_data_scope)
+):
+    query = {} if include_archived else {"is_active": True}
+    
+    text_queries = search.candidate_queries(q) if q else []
+    if q and not text_queries:
+        return []
+    
+    if kelas_id:
+        query["kelas_id"] = kelas_id
+    
+    if jurusan_id:
+        kelas_ids = await db.kelas.distinct("id", {"jurusan_id": jurusan_id})
+        query["$and"] = [{"kelas_id": {"$in": kelas_ids}}]
+        
+    # If wali kelas, only show their students
+    query = scope.restrict_siswa(query)
+    if query is None:
+        return []
+    
+    selected = serialization.parse_fields(Siswa, fields)
+    collections = [db.siswa, db[archive.ARCHIVE_COLLECTION]] if include_archived else [db.siswa]
+    if not q:
+        projection = serialization.projection_for(Siswa, selected)
+        siswa_list = []
+        for collection in collections:
+            siswa_list += await collection.find(query, projection).sort("id", 1).limit(offset + limit).to_list(offset + limit)
+        siswa_list = sorted(siswa_list, key=lambda s: s["id"])[offset:offset + limit]
+        siswa_list = list(map(with_foto_urls(request), siswa_list))
+        return serialization.json_response(serialization.trusted(Siswa, siswa_list, selected))
+    
+    # Ranking needs the name and codes even when the client did not ask for them
+    fetched = selected and list(dict.fromkeys([*selected, *search.RANK_FIELDS, "id"]))
+    projection = serialization.projection_for(Siswa, fetched)
+    # Best matches first, so the candidate cap only ever cuts off weaker ones
+    candidates = {}
+    for text_query in text_queries:
+        for collection in collections:
+            matches = await collection.find({"$and": [query, text_query]}, projection).limit(search.MAX_CANDIDATES).to_list(search.MAX_CANDIDATES)
+            for doc in matches:
+                if len(candidates) >= search.MAX_CANDIDATES:
+                    break
+                candidates.setdefault(doc["id"], doc)
+    page = search.rank(list(candidates.values()), q)[offset:offset + limit]
+    if selected:
+        page = [{k: s[k] for k in selected if k in s} for s in page]
+    page = list(map(with_foto_urls(request), page))
+    return serialization.json_response(serialization.trusted(Siswa, page, selected))
+
 # CRUD Operations for Siswa (Admin only)
 @api_router.get("/siswa/{siswa_id}", response_model=Siswa)
-async def get_siswa_by_id(siswa_id: str, current_user: User = Depends(require_role([UserRole.ADMIN, UserRole.WALI_KELAS]))):
-    siswa = await db.siswa.find_one({"id": siswa_id, "is_active": True})
+async def get_siswa_by_id(siswa_id: str, response: Response, include_archived: bool = False, current_user: User = Depends(require_role([UserRole.ADMIN, UserRole.WALI_KELAS])), scope: DataScope = Depends(get_data_scope)):
+    query = scope.restrict_siswa({"id": siswa_id} if include_archived else {"id": siswa_id, "is_active": True})
+    siswa = await db.siswa.find_one(query) if query else None
+    if not siswa and query and include_archived:
+        siswa = await db[archive.ARCHIVE_COLLECTION].find_one(query)
     if not siswa:
         raise HTTPException(status_code=404, detail="Siswa not found")
+    set_etag(response, siswa)
     return Siswa(**siswa)
 
-@api_router.put("/siswa/{siswa_id}", response_model=Siswa)
-async def update_siswa(siswa_id: str, siswa_data: Siswa, current_user: User = Depends(require_role([UserRole.ADMIN]))):
-    existing_siswa = await db.siswa.find_one({"id": siswa_id})
-    if not existing_siswa:
-        raise HTTPException(status_code=404, detail="Siswa not found")
-    
-    await db.siswa.update_one({"id": siswa_id}, {"$set": siswa_data.dict()})
-    updated_siswa = await db.siswa.find_one({"id": siswa_id})
+async def _update_siswa(siswa_id: str, fields: Dict[str, Any], if_match: Optional[str], response: Response) -> Siswa:
+    if "nama_lengkap" in fields:
+        fields = {**fields, **search.search_fields(fields)}
+    if "foto" in fields:
+        fields["foto"] = await photos.resolve_foto(photo_store, fields["foto"])
+    if fields.get("is_active"):
+        fields.update(archive.activity_fields(True))
+    existing_siswa, updated_siswa = await update_document(db.siswa, siswa_id, fields, if_match, "Siswa")
+    if existing_siswa.get("is_active", True) and updated_siswa.get("is_active") is False:
+        # Start the archive grace period now, as delete_siswa does; only on the change, so
+        # edits to an already-inactive siswa do not restart the clock
+        await db.siswa.update_one(
+            {"id": siswa_id, "is_active": False, archive.INACTIVE_SINCE: None}, {"$set": archive.activity_fields(False)},
+        )
+    await dashboard_counters.siswa_changed(db, existing_siswa, updated_siswa)
+    set_etag(response, updated_siswa)
     return Siswa(**updated_siswa)
 
+@api_router.put("/siswa/{siswa_id}", response_model=Siswa)
+async def update_siswa(siswa_id: str, siswa_data: Siswa, response: Response, if_match: Optional[str] = Header(None), current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    return await _update_siswa(siswa_id, siswa_data.dict(exclude={"id", "version"}), if_match, response)
+
+@api_router.patch("/siswa/{siswa_id}", response_model=Siswa)
+async def patch_siswa(siswa_id: str, siswa_data: SiswaUpdate, response: Response, if_match: Optional[str] = Header(None), current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    return await _update_siswa(siswa_id, partial_fields(siswa_data, Siswa), if_match, response)
+
 @api_router.delete("/siswa/{siswa_id}")
 async def delete_siswa(siswa_id: str, current_user: User = Depends(require_role([UserRole.ADMIN]))):
-    result = await db.siswa.update_one({"id": siswa_id}, {"$set": {"is_active": False}})
-    if result.modified_count == 0:
+    deleted_siswa = await db.siswa.find_one_and_update(
+        {"id": siswa_id, "is_active": True},
+        {"$set": {"is_active": False, **archive.activity_fields(False)}, "$inc": {"version": 1}},
+    )
+    if deleted_siswa is None:
         raise HTTPException(status_code=404, detail="Siswa not found")
+    await dashboard_counters.siswa_changed(db, deleted_siswa, None)
     return {"message": "Siswa deleted successfully"}
 
+@api_router.post("/siswa/archive/run")
+async def run_siswa_archive(current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    """Archive long-inactive siswa now instead of waiting for the scheduled pass"""
+    return await siswa_archiver.run_once(db)
+
+# Siswa photos
+@api_router.put("/siswa/{siswa_id}/foto", response_model=Siswa)
+async def upload_siswa_foto(siswa_id: str, response: Response, file: UploadFile = File(...), if_match: Optional[str] = Header(None), current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    """Store a photo (and its thumbnail) and point the siswa at it"""
+    # Checked first, so a bad id does not leave an orphaned file in the store
+    if not await db.siswa.count_documents({"id": siswa_id}, limit=1):
+        raise HTTPException(status_code=404, detail="Siswa not found")
+    data = await file.read(photos.MAX_UPLOAD_BYTES + 1)
+    digest = await photo_store.save_async(data)
+    return await _update_siswa(siswa_id, {"foto": photos.url_for(digest)}, if_match, response)
+
+@api_router.delete("/siswa/{siswa_id}/foto", response_model=Siswa)
+async def delete_siswa_foto(siswa_id: str, response: Response, if_match: Optional[str] = Header(None), current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    # The file itself stays: content-addressed photos may be shared
+    return await _update_siswa(siswa_id, {"foto": None}, if_match, response)
+
+@api_router.get("/siswa/{siswa_id}/foto")
+async def get_siswa_foto_urls(siswa_id: str, request: Request, current_user: User = Depends(require_role([UserRole.ADMIN, UserRole.WALI_KELAS])), scope: DataScope = Depends(get_data_scope)):
+    """Signed photo URLs usable directly as <img src>, without the Authorization header"""
+    query = scope.restrict_siswa({"id": siswa_id, "is_active": True})
+    siswa = await db.siswa.find_one(query, {"_id": 0, "foto": 1}) if query else None
+    if not siswa:
+        raise HTTPException(status_code=404, detail="Siswa not found")
+    foto = siswa.get("foto")
+    if not foto:
+        raise HTTPException(status_code=404, detail="Siswa has no foto")
+    if not photos.is_reference(foto):
+        # An external URL is already usable as it is
+        return {"url": foto, "thumb_url": foto, "expires_at": None}
+    digest = foto[len(photos.URL_PREFIX):]
+    base_url = public_base_url(request)
+    url, expires = photo_signer.url(base_url, digest, "full")
+    thumb_url, _ = photo_signer.url(base_url, digest, "thumb")
+    return {"url": url, "thumb_url": thumb_url, "expires_at": datetime.fromtimestamp(expires, timezone.utc)}
+
+@api_router.get("/foto/{digest}")
+async def get_foto(
+    digest: str,
+    request: Request,
+    size: str = Query("full", pattern="^(full|thumb)$"),
+    expires: Optional[int] = None,
+    sig: Optional[str] = None,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security),
+):
+    # A valid signature stands in for the Bearer token
+    if not photo_signer.verify(digest, size, expires, sig):
+        if credentials is None and batch.PRINCIPAL_SCOPE_KEY not in request.scope:
+            raise HTTPException(status_code=401, detail="Not authenticated")
+        await get_current_user(request, credentials)
+    return photos.photo_response(request, photo_store, digest, size)
+
 # CRUD Operations for Guru (Admin only)
 @api_router.get("/guru", response_model=List[Guru])
-async def get_guru_list(current_user: User = Depends(require_role([UserRole.ADMIN]))):
-    guru_list = await db.guru.find().to_list(1000)
-    return [Guru(**g) for g in guru_list]
+async def get_guru_list(request: Request, page: PageParams = Depends(page_params), current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    return await paginate(request, db.guru, {}, Guru, page)
 
 @api_router.get("/guru/{guru_id}", response_model=Guru)
-async def get_guru_by_id(guru_id: str, current_user: User = Depends(require_role([UserRole.ADMIN]))):
+async def get_guru_by_id(guru_id: str, response: Response, current_user: User = Depends(require_role([UserRole.ADMIN]))):
     guru = await db.guru.find_one({"id": guru_id})
     if not guru:
         raise HTTPException(status_code=404, detail="Guru not found")
+    set_etag(response, guru)
     return Guru(**guru)
 
 @api_router.post("/guru", response_model=Guru)
 async def create_guru(guru: Guru, current_user: User = Depends(require_role([UserRole.ADMIN]))):
     await db.guru.insert_one(guru.dict())
+    await dashboard_counters.increment(db, {"guru": 1})
+    scope_resolver.clear()
     return guru
 
-@api_router.put("/guru/{guru_id}", response_model=Guru)
-async def update_guru(guru_id: str, guru_data: Guru, current_user: User = Depends(require_role([UserRole.ADMIN]))):
-    existing_guru = await db.guru.find_one({"id": guru_id})
-    if not existing_guru:
-        raise HTTPException(status_code=404, detail="Guru not found")
-    
-    await db.guru.update_one({"id": guru_id}, {"$set": guru_data.dict()})
-    updated_guru = await db.guru.find_one({"id": guru_id})
+async def _update_guru(guru_id: str, fields: Dict[str, Any], if_match: Optional[str], response: Response) -> Guru:
+    _, updated_guru = await update_document(db.guru, guru_id, fields, if_match, "Guru")
+    scope_resolver.clear()
+    set_etag(response, updated_guru)
     return Guru(**updated_guru)
 
+@api_router.put("/guru/{guru_id}", response_model=Guru)
+async def update_guru(guru_id: str, guru_data: Guru, response: Response, if_match: Optional[str] = Header(None), current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    return await _update_guru(guru_id, guru_data.dict(exclude={"id", "version"}), if_match, response)
+
+@api_router.patch("/guru/{guru_id}", response_model=Guru)
+async def patch_guru(guru_id: str, guru_data: GuruUpdate, response: Response, if_match: Optional[str] = Header(None), current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    return await _update_guru(guru_id, partial_fields(guru_data, Guru), if_match, response)
+
 @api_router.delete("/guru/{guru_id}")
 async def delete_guru(guru_id: str, current_user: User = Depends(require_role([UserRole.ADMIN]))):
     result = await db.guru.delete_one({"id": guru_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Guru not found")
+    await dashboard_counters.increment(db, {"guru": -1})
+    scope_resolver.clear()
     return {"message": "Guru deleted successfully"}
 
 # CRUD Operations for Kelas (Admin only)
-@api_router.put("/kelas/{kelas_id}", response_model=Kelas)
-async def update_kelas(kelas_id: str, kelas_data: Kelas, current_user: User = Depends(require_role([UserRole.ADMIN]))):
-    existing_kelas = await db.kelas.find_one({"id": kelas_id})
-    if not existing_kelas:
-        raise HTTPException(status_code=404, detail="Kelas not found")
-    
-    await db.kelas.update_one({"id": kelas_id}, {"$set": kelas_data.dict()})
-    updated_kelas = await db.kelas.find_one({"id": kelas_id})
+async def _update_kelas(kelas_id: str, fields: Dict[str, Any], if_match: Optional[str], response: Response) -> Kelas:
+    existing_kelas, updated_kelas = await update_document(db.kelas, kelas_id, fields, if_match, "Kelas")
+    scope_resolver.invalidate([existing_kelas.get("wali_kelas_id"), updated_kelas.get("wali_kelas_id")])
+    await master_data.bump(db, "kelas")
+    set_etag(response, updated_kelas)
     return Kelas(**updated_kelas)
 
+@api_router.put("/kelas/{kelas_id}", response_model=Kelas)
+async def update_kelas(kelas_id: str, kelas_data: Kelas, response: Response, if_match: Optional[str] = Header(None), current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    return await _update_kelas(kelas_id, kelas_data.dict(exclude={"id", "version"}), if_match, response)
+
+@api_router.patch("/kelas/{kelas_id}", response_model=Kelas)
+async def patch_kelas(kelas_id: str, kelas_data: KelasUpdate, response: Response, if_match: Optional[str] = Header(None), current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    return await _update_kelas(kelas_id, partial_fields(kelas_data, Kelas), if_match, response)
+
 @api_router.delete("/kelas/{kelas_id}")
 async def delete_kelas(kelas_id: str, current_user: User = Depends(require_role([UserRole.ADMIN]))):
-    result = await db.kelas.delete_one({"id": kelas_id})
-    if result.deleted_count == 0:
+    deleted_kelas = await db.kelas.find_one_and_delete({"id": kelas_id})
+    if deleted_kelas is None:
         raise HTTPException(status_code=404, detail="Kelas not found")
+    await dashboard_counters.kelas_deleted(db, kelas_id)
+    scope_resolver.invalidate([deleted_kelas.get("wali_kelas_id")])
+    await master_data.bump(db, "kelas")
     return {"message": "Kelas deleted successfully"}
 
 # CRUD Operations for Mapel (Admin only)
 @api_router.get("/mapel", response_model=List[Mapel])
-async def get_mapel_list(jenis: Optional[str] = None, current_user: User = Depends(get_current_user)):
+async def get_mapel_list(request: Request, jenis: Optional[str] = None, page: PageParams = Depends(page_params), current_user: User = Depends(get_current_user)):
     query = {}
     if jenis:
         query["jenis"] = jenis
     
-    mapel_list = await db.mapel.find(query).to_list(1000)
-    return [Mapel(**m) for m in mapel_list]
+    return await master_data.respond(request, db, "mapel", lambda: paginate(request, db.mapel, query, Mapel, page))
 
 @api_router.post("/mapel", response_model=Mapel)
 async def create_mapel(mapel: Mapel, current_user: User = Depends(require_role([UserRole.ADMIN]))):
-    await db.mapel.insert_one(mapel.dict())
+    try:
+        await db.mapel.insert_one(mapel.dict())
+    except DuplicateKeyError as e:
+        raise duplicate_key_conflict(e, "Mapel")
+    await master_data.bump(db, "mapel")
+    await dashboard_counters.increment(db, {"mapel": 1})
+    # Guru-to-mapel assignments are rare admin edits; drop every cached scope
+    scope_resolver.clear()
     return mapel
 
-@api_router.put("/mapel/{mapel_id}", response_model=Mapel)
-async def update_mapel(mapel_id: str, mapel_data: Mapel, current_user: User = Depends(require_role([UserRole.ADMIN]))):
-    existing_mapel = await db.mapel.find_one({"id": mapel_id})
-    if not existing_mapel:
-        raise HTTPException(status_code=404, detail="Mapel not found")
-    
-    await db.mapel.update_one({"id": mapel_id}, {"$set": mapel_data.dict()})
-    updated_mapel = await db.mapel.find_one({"id": mapel_id})
+async def _update_mapel(mapel_id: str, fields: Dict[str, Any], if_match: Optional[str], response: Response) -> Mapel:
+    _, updated_mapel = await update_document(db.mapel, mapel_id, fields, if_match, "Mapel")
+    await master_data.bump(db, "mapel")
+    scope_resolver.clear()
+    set_etag(response, updated_mapel)
     return Mapel(**updated_mapel)
 
+@api_router.put("/mapel/{mapel_id}", response_model=Mapel)
+async def update_mapel(mapel_id: str, mapel_data: Mapel, response: Response, if_match: Optional[str] = Header(None), current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    return await _update_mapel(mapel_id, mapel_data.dict(exclude={"id", "version"}), if_match, response)
+
+@api_router.patch("/mapel/{mapel_id}", response_model=Mapel)
+async def patch_mapel(mapel_id: str, mapel_data: MapelUpdate, response: Response, if_match: Optional[str] = Header(None), current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    return await _update_mapel(mapel_id, partial_fields(mapel_data, Mapel), if_match, response)
+
 @api_router.delete("/mapel/{mapel_id}")
 async def delete_mapel(mapel_id: str, current_user: User = Depends(require_role([UserRole.ADMIN]))):
     result = await db.mapel.delete_one({"id": mapel_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Mapel not found")
+    await dashboard_counters.increment(db, {"mapel": -1})
+    await master_data.bump(db, "mapel")
+    scope_resolver.clear()
     return {"message": "Mapel deleted successfully"}
 
 # CRUD Operations for Tahun Ajaran (Admin only)
 @api_router.get("/tahun-ajaran", response_model=List[TahunAjaran])
-async def get_tahun_ajaran_list(current_user: User = Depends(require_role([UserRole.ADMIN]))):
-    tahun_ajaran_list = await db.tahun_ajaran.find().to_list(1000)
-    return [TahunAjaran(**ta) for ta in tahun_ajaran_list]
+async def get_tahun_ajaran_list(request: Request, page: PageParams = Depends(page_params), current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    return await master_data.respond(request, db, "tahun_ajaran", lambda: paginate(request, db.tahun_ajaran, {}, TahunAjaran, page))
 
 @api_router.post("/tahun-ajaran", response_model=TahunAjaran)
 async def create_tahun_ajaran(tahun_ajaran: TahunAjaran, current_user: User = Depends(require_role([UserRole.ADMIN]))):
-    # If this is set as active, deactivate others
-    if tahun_ajaran.is_active:
-        await db.tahun_ajaran.update_many({}, {"$set": {"is_active": False}})
+    try:
+        await db.tahun_ajaran.insert_one(tahun_ajaran.dict())
+    except DuplicateKeyError as e:
+        raise duplicate_key_conflict(e, "Tahun Ajaran")
     
-    await db.tahun_ajaran.insert_one(tahun_ajaran.dict())
+    # If this is set as active, deactivate others; only now that the insert succeeded
+    if tahun_ajaran.is_active:
+        await db.tahun_ajaran.update_many(
+            {"id": {"$ne": tahun_ajaran.id}, "is_active": True},
+            {"$set": {"is_active": False}, "$inc": {"version": 1}},
+        )
+    await master_data.bump(db, "tahun_ajaran")
     return tahun_ajaran
 
-@api_router.put("/tahun-ajaran/{ta_id}", response_model=TahunAjaran)
-async def update_tahun_ajaran(ta_id: str, ta_data: TahunAjaran, current_user: User = Depends(require_role([UserRole.ADMIN]))):
-    existing_ta = await db.tahun_ajaran.find_one({"id": ta_id})
-    if not existing_ta:
-        raise HTTPException(status_code=404, detail="Tahun Ajaran not found")
+async def _update_tahun_ajaran(ta_id: str, fields: Dict[str, Any], if_match: Optional[str], response: Response) -> TahunAjaran:
+    _, updated_ta = await update_document(db.tahun_ajaran, ta_id, fields, if_match, "Tahun Ajaran")
     
     # If this is set as active, deactivate others
-    if ta_data.is_active:
-        await db.tahun_ajaran.update_many({}, {"$set": {"is_active": False}})
+    if fields.get("is_active"):
+        await db.tahun_ajaran.update_many(
+            {"id": {"$ne": ta_id}, "is_active": True},
+            {"$set": {"is_active": False}, "$inc": {"version": 1}},
+        )
+    await master_data.bump(db, "tahun_ajaran")
     
-    await db.tahun_ajaran.update_one({"id": ta_id}, {"$set": ta_data.dict()})
-    updated_ta = await db.tahun_ajaran.find_one({"id": ta_id})
+    set_etag(response, updated_ta)
     return TahunAjaran(**updated_ta)
 
+@api_router.put("/tahun-ajaran/{ta_id}", response_model=TahunAjaran)
+async def update_tahun_ajaran(ta_id: str, ta_data: TahunAjaran, response: Response, if_match: Optional[str] = Header(None), current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    return await _update_tahun_ajaran(ta_id, ta_data.dict(exclude={"id", "version"}), if_match, response)
+
+@api_router.patch("/tahun-ajaran/{ta_id}", response_model=TahunAjaran)
+async def patch_tahun_ajaran(ta_id: str, ta_data: TahunAjaranUpdate, response: Response, if_match: Optional[str] = Header(None), current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    return await _update_tahun_ajaran(ta_id, partial_fields(ta_data, TahunAjaran), if_match, response)
+
 @api_router.delete("/tahun-ajaran/{ta_id}")
 async def delete_tahun_ajaran(ta_id: str, current_user: User = Depends(require_role([UserRole.ADMIN]))):
     result = await db.tahun_ajaran.delete_one({"id": ta_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Tahun Ajaran not found")
+    await master_data.bump(db, "tahun_ajaran")
     return {"message": "Tahun Ajaran deleted successfully"}
 
-# Search and Filter endpoints
-@api_router.get("/siswa/search")
-async def search_siswa(
-    q: Optional[str] = None,
-    kelas_id: Optional[str] = None, 
-    jurusan_id: Optional[str] = None,
-    current_user: User = Depends(require_role([UserRole.ADMIN, UserRole.WALI_KELAS]))
-):
-    query = {"is_active": True}
-    
-    if q:
-        query["$or"] = [
-            {"nama_lengkap": {"$regex": q, "$options": "i"}},
-            {"nis": {"$regex": q, "$options": "i"}},
-            {"nisn": {"$regex": q, "$options": "i"}}
-        ]
-    
-    if kelas_id:
-        query["kelas_id"] = kelas_id
-        
-    # If wali kelas, only show their students
-    if current_user.role == UserRole.WALI_KELAS:
-        wali_kelas = await db.kelas.find_one({"wali_kelas_id": current_user.id})
-        if wali_kelas:
-            query["kelas_id"] = wali_kelas["id"]
-        else:
-            return []
-    
-    siswa_list = await db.siswa.find(query).limit(100).to_list(100)
-    return [Siswa(**s) for s in siswa_list]
-
 # Get detailed kelas with jurusan info
+# localField/foreignField lookups are served by the joined collection's id_unique
+# index on every MongoDB version; let/pipeline with $expr is not before 5.0
+KELAS_DETAILED_PIPELINE = [
+    {"$lookup": {"from": "jurusan", "localField": "jurusan_id", "foreignField": "id", "as": "jurusan"}},
+    {"$lookup": {"from": "users", "localField": "wali_kelas_id", "foreignField": "id", "as": "wali_kelas"}},
+    {"$set": {
+        "jurusan": {"$ifNull": [{"$arrayElemAt": ["$jurusan", 0]}, None]},
+        "wali_kelas": {"$ifNull": [{"$arrayElemAt": ["$wali_kelas", 0]}, None]},
+    }},
+    {"$project": {"_id": 0, "jurusan._id": 0, "wali_kelas._id": 0, "wali_kelas.password": 0}},
+]
+
 @api_router.get("/kelas/detailed")
 async def get_kelas_detailed(current_user: User = Depends(get_current_user)):
-    kelas_list = await db.kelas.find().to_list(1000)
-    detailed_kelas = []
-    
+    # One round trip for jurusan and wali kelas; siswa counts come from the maintained dashboard counters
+    kelas_list = await db.kelas.aggregate(KELAS_DETAILED_PIPELINE).to_list(None)
+    siswa_by_kelas = (await dashboard_counters.get(db)).get(SISWA_BY_KELAS, {})
     for kelas in kelas_list:
-        # Get jurusan info
-        jurusan = await db.jurusan.find_one({"id": kelas["jurusan_id"]})
-        
-        # Get wali kelas info if assigned
-        wali_kelas = None
-        if kelas.get("wali_kelas_id"):
-            wali_kelas = await db.users.find_one({"id": kelas["wali_kelas_id"]})
-        
-        # Count siswa in this kelas
-        siswa_count = await db.siswa.count_documents({"kelas_id": kelas["id"], "is_active": True})
-        
-        detailed_kelas.append({
-            **kelas,
-            "jurusan": jurusan,
-            "wali_kelas": wali_kelas,
-            "siswa_count": siswa_count
-        })
-    
-    return detailed_kelas
+        kelas["siswa_count"] = siswa_by_kelas.get(kelas["id"], 0)
+    return kelas_list
+
+@api_router.post("/tahun-ajaran/{ta_id}/rollover")
+async def rollover_tahun_ajaran(ta_id: str, rollover_request: RolloverRequest, current_user: User = Depends(require_role([UserRole.ADMIN]))):
+    """Promote every class X->XI->XII, graduate XII and make ta_id the active tahun ajaran.
+
+    With dry_run the plan is returned without writing anything.
+    """
+    target = await db.tahun_ajaran.find_one({"id": ta_id}, {"_id": 0})
+    if not target:
+        raise HTTPException(status_code=404, detail="Tahun Ajaran not found")
+    plan = await rollover.plan_rollover(db, target, rollover_request.wali_follows_class)
+    if rollover_request.dry_run:
+        return {"dry_run": True, **plan.as_dict()}
+    if plan.problems:
+        raise HTTPException(status_code=409, detail={"message": "Rollover cannot be applied", "problems": plan.problems})
+    try:
+        record = await rollover.apply_rollover(db, plan, current_user.id)
+    except rollover.RolloverConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except rollover.TransactionsUnsupported as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+    await dashboard_counters.reconcile(db)
+    await master_data.bump(db, "tahun_ajaran")
+    if plan.wali_changes:
+        await master_data.bump(db, "kelas")
+        scope_resolver.clear()
+    return {"dry_run": False, **record}
+
+# Nilai (grades)
+def _can_grade(scope: DataScope, kelas_id: str, mapel_id: str) -> bool:
+    return scope.unrestricted or mapel_id in scope.mapel_ids or kelas_id in scope.kelas_ids
+
+GRADING_ROLES = [UserRole.ADMIN, UserRole.GURU_MAPEL, UserRole.GURU_EKSTRA, UserRole.WALI_KELAS]
+
+@api_router.get("/nilai", response_model=List[Nilai])
+async def get_nilai(request: Request, kelas_id: str, mapel_id: str, tahun_ajaran_id: str, page: PageParams = Depends(page_params), current_user: User = Depends(require_role(GRADING_ROLES)), scope: DataScope = Depends(get_data_scope)):
+    if not _can_grade(scope, kelas_id, mapel_id):
+        raise HTTPException(status_code=403, detail="Insufficient permissions")
+    query = {"tahun_ajaran_id": tahun_ajaran_id, "kelas_id": kelas_id, "mapel_id": mapel_id}
+    return await paginate(request, db.nilai, query, Nilai, page)
+
+@api_router.post("/nilai/bulk")
+async def save_nilai_bulk(submission: NilaiBulk, current_user: User = Depends(require_role(GRADING_ROLES)), scope: DataScope = Depends(get_data_scope)):
+    """Enter or correct one mapel's grades for a whole kelas"""
+    if not _can_grade(scope, submission.kelas_id, submission.mapel_id):
+        raise HTTPException(status_code=403, detail="Insufficient permissions")
+    mapel_exists, tahun_exists = await asyncio.gather(
+        db.mapel.count_documents({"id": submission.mapel_id}, limit=1),
+        db.tahun_ajaran.count_documents({"id": submission.tahun_ajaran_id}, limit=1),
+    )
+    if not mapel_exists:
+        raise HTTPException(status_code=404, detail="Mapel not found")
+    if not tahun_exists:
+        raise HTTPException(status_code=404, detail="Tahun Ajaran not found")
+    return await nilai.save_bulk(db, submission.kelas_id, submission.mapel_id, submission.tahun_ajaran_id, submission.nilai, current_user.id)
+
+# Rapor (report cards)
+async def _tahun_ajaran_for(tahun_ajaran_id: Optional[str]) -> Dict[str, Any]:
+    query = {"id": tahun_ajaran_id} if tahun_ajaran_id else {"is_active": True}
+    tahun_ajaran = await db.tahun_ajaran.find_one(query, {"_id": 0})
+    if not tahun_ajaran:
+        raise HTTPException(status_code=404, detail="Tahun Ajaran not found")
+    return tahun_ajaran
+
+@api_router.post("/rapor/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def create_rapor_job(job_request: RaporJobRequest, current_user: User = Depends(require_role([UserRole.ADMIN, UserRole.WALI_KELAS])), scope: DataScope = Depends(get_data_scope)):
+    """Start generating rapor PDFs for one kelas (or every kelas) in the background"""
+    tahun_ajaran = await _tahun_ajaran_for(job_request.tahun_ajaran_id)
+    if job_request.kelas_id:
+        if not scope.unrestricted and job_request.kelas_id not in scope.kelas_ids:
+            raise HTTPException(status_code=403, detail="Insufficient permissions")
+        kelas_query = {"id": job_request.kelas_id}
+    else:
+        kelas_query = {} if scope.unrestricted else {"id": {"$in": list(scope.kelas_ids)}}
+    kelas_list = await db.kelas.find(kelas_query, {"_id": 0}).sort("nama_kelas", 1).to_list(None)
+    if not kelas_list:
+        raise HTTPException(status_code=404, detail="Kelas not found")
+    job = await rapor_jobs.start(db, tahun_ajaran, kelas_list, current_user.id)
+    return {"id": job["id"], "status": job["status"], "total": job["total"]}
+
+async def _rapor_job(job_id: str, current_user: User) -> Dict[str, Any]:
+    job = await rapor_jobs.get(db, job_id)
+    if not job or (current_user.role != UserRole.ADMIN and job["requested_by"] != current_user.id):
+        raise HTTPException(status_code=404, detail="Rapor job not found")
+    return job
+
+@api_router.get("/rapor/jobs/{job_id}")
+async def get_rapor_job(job_id: str, current_user: User = Depends(require_role([UserRole.ADMIN, UserRole.WALI_KELAS]))):
+    job = await _rapor_job(job_id, current_user)
+    job.pop("kelas_ids", None)
+    return job
+
+@api_router.get("/rapor/jobs/{job_id}/download")
+async def download_rapor_job(job_id: str, current_user: User = Depends(require_role([UserRole.ADMIN, UserRole.WALI_KELAS]))):
+    job = await _rapor_job(job_id, current_user)
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Rapor job is {job['status']}")
+    path = rapor_jobs.path_for(job_id)
+    if not path.exists():
+        raise HTTPException(status_code=410, detail="Rapor archive is no longer available")
+    return FileResponse(path, media_type="application/zip", filename=f"rapor-{job_id[:8]}.zip")
+
+@api_router.get("/rapor/siswa/{siswa_id}")
+async def get_rapor_siswa(siswa_id: str, tahun_ajaran_id: Optional[str] = None, current_user: User = Depends(require_role([UserRole.ADMIN, UserRole.WALI_KELAS])), scope: DataScope = Depends(get_data_scope)):
+    """A single rapor PDF, rendered on demand"""
+    query = scope.restrict_siswa({"id": siswa_id, "is_active": True})
+    siswa = await db.siswa.find_one(query, rapor.SISWA_FIELDS | {"kelas_id": 1}) if query else None
+    if not siswa:
+        raise HTTPException(status_code=404, detail="Siswa not found")
+    tahun_ajaran = await _tahun_ajaran_for(tahun_ajaran_id)
+    kelas = await db.kelas.find_one({"id": siswa["kelas_id"]}, {"_id": 0})
+    if not kelas:
+        raise HTTPException(status_code=404, detail="Kelas not found")
+    context = await rapor.load_context(db, tahun_ajaran, [kelas], rapor_jobs.sekolah)
+    card, = await rapor.cards_for(db, [siswa], kelas, context, tahun_ajaran["id"])
+    pdf = await rapor_jobs.render_one(card)
+    filename = rapor.filename_for(card).rsplit("/", 1)[-1]
+    return Response(pdf, media_type="application/pdf", headers={"Content-Disposition": f'inline; filename="{filename}"'})
+
+# Composite requests
+@api_router.post("/batch")
+async def run_batch(batch_request: BatchRequest, request: Request, current_user: User = Depends(get_current_user)):
+    """Run several GET requests concurrently and return every result, in order, with its own status"""
+    return await batch.run_batch(request, api_router.routes, batch_request.requests, current_user)
 
 # Initialize default data
 @api_router.post("/init/default-data")
 async def init_default_data(current_user: User = Depends(require_role([UserRole.ADMIN]))):
     """Initialize default jurusan, kelas, and mapel data"""
+    seed = seeding.default_seed({"jurusan": Jurusan, "kelas": Kelas, "mapel": Mapel, "tahun_ajaran": TahunAjaran})
+    report = await seeding.apply_seed(db, seed)
+    await master_data.bump(db, *[c for c, counts in report.items() if counts["inserted"]])
     
-    # Default jurusan
-    default_jurusan = [
-        {"kode_jurusan": "AKL", "nama_jurusan": "Akuntansi dan Keuangan Lembaga"},
-        {"kode_jurusan": "MP", "nama_jurusan": "Manajemen Perkantoran"},
-        {"kode_jurusan": "RPL", "nama_jurusan": "Rekayasa Perangkat Lunak"},
-        {"kode_jurusan": "TO", "nama_jurusan": "Teknik Otomotif (TSM)"}
-    ]
-    
-    for j_data in default_jurusan:
-        existing = await db.jurusan.find_one({"kode_jurusan": j_data["kode_jurusan"]})
-        if not existing:
-            j_obj = Jurusan(**j_data)
-            await db.jurusan.insert_one(j_obj.dict())
-    
-    # Create default kelas for each jurusan
-    jurusan_list = await db.jurusan.find().to_list(1000)
-    tingkatan = ["X", "XI", "XII"]
-    
-    for tingkat in tingkatan:
-        for jurusan in jurusan_list:
-            kelas_name = f"{tingkat} {jurusan['kode_jurusan']} 1"
-            existing = await db.kelas.find_one({"nama_kelas": kelas_name})
-            if not existing:
-                kelas_obj = Kelas(
-                    tingkatan=tingkat,
-                    jurusan_id=jurusan["id"],
-                    nama_kelas=kelas_name
-                )
-                await db.kelas.insert_one(kelas_obj.dict())
-    
-    # Default mapel
-    default_mapel = [
-        {"kode_mapel": "PABP", "nama_mapel": "Pendidikan Agama dan Budi Pekerti", "jenis": "umum"},
-        {"kode_mapel": "PPKN", "nama_mapel": "Pendidikan Pancasila dan Kewarganegaraan", "jenis": "umum"},
-        {"kode_mapel": "BINDO", "nama_mapel": "Bahasa Indonesia", "jenis": "umum"},
-        {"kode_mapel": "MAT", "nama_mapel": "Matematika", "jenis": "umum"},
-        {"kode_mapel": "SEJ", "nama_mapel": "Sejarah", "jenis": "umum"},
-        {"kode_mapel": "BING", "nama_mapel": "Bahasa Inggris", "jenis": "umum"},
-        {"kode_mapel": "PJOK", "nama_mapel": "Pendidikan Jasmani, Olahraga, dan Kesehatan", "jenis": "umum"},
-        {"kode_mapel": "AKL1", "nama_mapel": "Akuntansi Dasar", "jenis": "kejuruan"},
-        {"kode_mapel": "MP1", "nama_mapel": "Otomatisasi Tata Kelola Perkantoran", "jenis": "kejuruan"},
-        {"kode_mapel": "RPL1", "nama_mapel": "Pemrograman Dasar", "jenis": "kejuruan"},
-        {"kode_mapel": "TO1", "nama_mapel": "Teknik Kendaraan Ringan", "jenis": "kejuruan"},
-        {"kode_mapel": "P5", "nama_mapel": "Projek P5", "jenis": "p5"},
-        {"kode_mapel": "PRAM", "nama_mapel": "Pramuka", "jenis": "ekstra"},
-        {"kode_mapel": "PMR", "nama_mapel": "Palang Merah Remaja", "jenis": "ekstra"}
-    ]
-    
-    for m_data in default_mapel:
-        existing = await db.mapel.find_one({"kode_mapel": m_data["kode_mapel"]})
-        if not existing:
-            m_obj = Mapel(**m_data)
-            await db.mapel.insert_one(m_obj.dict())
-    
-    # Create default tahun ajaran
-    current_year = 2024
-    default_ta = f"{current_year}/{current_year + 1}"
-    existing_ta = await db.tahun_ajaran.find_one({"tahun": default_ta})
-    if not existing_ta:
-        ta_ganjil = TahunAjaran(tahun=default_ta, semester="ganjil", is_active=True)
-        await db.tahun_ajaran.insert_one(ta_ganjil.dict())
-    
-    return {"message": "Default data initialized successfully"}
+    await dashboard_counters.reconcile(db)
+    return {"message": "Default data initialized successfully", "collections": report}
 
 # Include the router in the main app
 app.include_router(api_router)
@@ -526,7 +1111,32 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, "ETag", "Content-Range"],
 )
+app.add_middleware(SelectiveGZipMiddleware, minimum_size=int(os.environ.get('GZIP_MIN_BYTES', '1024')))
+# Outermost, so timings include compression and CORS handling
+app.add_middleware(metrics.MetricsMiddleware, slow_request_seconds=float(os.environ.get('SLOW_REQUEST_MS', '500')) / 1000)
+
+def _password_hash_metrics():
+    stats = password_hasher.metrics()
+    return [
+        "# TYPE password_hash_in_flight gauge",
+        f"password_hash_in_flight {stats['in_flight']}",
+        "# TYPE password_hash_rejected_total counter",
+        f"password_hash_rejected_total {stats['rejected']}",
+        "# TYPE password_hash_wait_seconds summary",
+        f"password_hash_wait_seconds_sum {password_hasher.wait_time.total}",
+        f"password_hash_wait_seconds_count {password_hasher.wait_time.count}",
+        "# TYPE password_hash_exec_seconds summary",
+        f"password_hash_exec_seconds_sum {password_hasher.exec_time.total}",
+        f"password_hash_exec_seconds_count {password_hasher.exec_time.count}",
+    ]
+
+metrics.register_collector(_password_hash_metrics)
+
+@app.get("/metrics", include_in_schema=False)
+async def get_prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 # Configure logging
 logging.basicConfig(
@@ -535,6 +1145,21 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_db_indexes():
+    await ensure_indexes(db)
+    await search.backfill_search_keys(db.siswa)
+    await search.backfill_search_keys(db[archive.ARCHIVE_COLLECTION])
+    await photos.migrate_inline_photos(db, photo_store)
+    await rapor_jobs.fail_stale(db)
+    dashboard_counters.start(db)
+    siswa_archiver.start(db)
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    dashboard_counters.stop()
+    siswa_archiver.stop()
+    # Before closing the client, so cancelled jobs can record that they failed
+    await rapor_jobs.shutdown()
+    client.close()
+    password_hasher.shutdown()
\ No newline at end of file
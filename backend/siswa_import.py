@@ -0,0 +1,227 @@
+"""Bulk siswa import from CSV or XLSX uploads.
+
+The upload is read row by row (Starlette has already spooled it to a temporary
+file) and processed in chunks: each chunk is validated against ``Siswa`` and
+written with one unordered ``bulk_write`` of upserts keyed on NIS. Only the
+current chunk and the kelas name map are held in memory.
+
+Expected columns: nis, nisn, nama_lengkap, jk, tanggal_lahir and either
+kelas (the class name, e.g. "X RPL 1") or kelas_id. An optional foto column
+may hold an image URL or inline base64 image data; the latter is moved into
+the photo store like an upload.
+"""
+import codecs
+import csv
+import datetime
+import uuid
+import zipfile
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from fastapi import HTTPException, UploadFile
+from pydantic import BaseModel, ValidationError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from starlette.concurrency import run_in_threadpool
+
+import search
+from archive import activity_fields
+from photos import PhotoError, PhotoStore, store_inline
+
+CHUNK_SIZE = 500
+MAX_REPORTED_ERRORS = 1000
+
+Row = Tuple[int, Dict[str, Any]]
+
+
+class ImportFileError(Exception):
+    """The upload cannot be read as a CSV/XLSX file from this row on."""
+
+
+def _normalize_header(name: Any) -> str:
+    return str(name or "").strip().lower().replace(" ", "_")
+
+
+def _cell(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        # Spreadsheets store numeric NIS/NISN as floats
+        value = int(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        value = value.strftime("%Y-%m-%d")
+    value = str(value).strip()
+    return value or None
+
+
+def _csv_rows(upload: UploadFile) -> Iterator[Row]:
+    text = codecs.getreader("utf-8-sig")(upload.file)
+    reader = csv.DictReader(text)
+    try:
+        reader.fieldnames = [_normalize_header(h) for h in reader.fieldnames or []]
+        for row in reader:
+            yield reader.line_num, {k: _cell(v) for k, v in row.items() if k}
+    except UnicodeDecodeError:
+        # Excel's plain "CSV" is the Windows code page, not UTF-8
+        raise ImportFileError(f"File is not UTF-8 encoded near row {reader.line_num + 1}; save it as \"CSV UTF-8\"")
+    except csv.Error as e:
+        raise ImportFileError(f"Row {reader.line_num}: {e}")
+
+
+# XML parse errors (ElementTree's and lxml's) derive from SyntaxError
+_XLSX_ERRORS = (zipfile.BadZipFile, KeyError, SyntaxError)
+
+
+def _xlsx_rows(upload: UploadFile) -> Iterator[Row]:
+    from openpyxl import load_workbook
+    from openpyxl.utils.exceptions import InvalidFileException
+
+    row_number = 1
+    try:
+        workbook = load_workbook(upload.file, read_only=True, data_only=True)
+    except (InvalidFileException, *_XLSX_ERRORS) as e:
+        raise ImportFileError(f"File is not a valid XLSX workbook: {e}")
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        headers = [_normalize_header(h) for h in next(rows, ())]
+        for row_number, values in enumerate(rows, start=2):
+            if all(v is None for v in values):
+                continue
+            yield row_number, {h: _cell(v) for h, v in zip(headers, values) if h}
+    except _XLSX_ERRORS as e:
+        raise ImportFileError(f"Workbook is corrupt after row {row_number}: {e}")
+    finally:
+        workbook.close()
+
+
+def iter_rows(upload: UploadFile) -> Iterator[Row]:
+    filename = (upload.filename or "").lower()
+    if filename.endswith(".xlsx") or "spreadsheetml" in (upload.content_type or ""):
+        return _xlsx_rows(upload)
+    return _csv_rows(upload)
+
+
+def _take(rows: Iterator[Row], n: int) -> List[Row]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= n:
+            break
+    return chunk
+
+
+class ImportReport:
+    def __init__(self):
+        self.total_rows = 0
+        self.inserted = 0
+        self.updated = 0
+        self.error_count = 0
+        self.errors: List[Dict[str, Any]] = []
+
+    def error(self, row: int, nis: Optional[str], message: str):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"row": row, "nis": nis, "error": message})
+
+    def as_dict(self):
+        return {
+            "total_rows": self.total_rows,
+            "inserted": self.inserted,
+            "updated": self.updated,
+            "failed": self.error_count,
+            "errors": self.errors,
+        }
+
+
+async def _kelas_map(db) -> Dict[str, str]:
+    """Lowercased class name -> kelas id, fetched once per import."""
+    kelas_list = await db.kelas.find({}, {"_id": 0, "id": 1, "nama_kelas": 1}).to_list(None)
+    return {k["nama_kelas"].strip().lower(): k["id"] for k in kelas_list}
+
+
+async def _write(db, ops: List[UpdateOne], row_numbers: List[int], niss: List[str], report: ImportReport):
+    try:
+        result = await db.siswa.bulk_write(ops, ordered=False)
+        report.inserted += result.upserted_count
+        report.updated += result.matched_count
+    except BulkWriteError as e:
+        details = e.details
+        report.inserted += details.get("nUpserted", 0)
+        report.updated += details.get("nMatched", 0)
+        for write_error in details.get("writeErrors", []):
+            i = write_error["index"]
+            report.error(row_numbers[i], niss[i], write_error.get("errmsg", "Write failed"))
+
+
+async def import_siswa(db, upload: UploadFile, model: type, photo_store: PhotoStore) -> Dict[str, Any]:
+    """Validate and upsert every row of ``upload`` using ``model`` (Siswa)."""
+    kelas_map = await _kelas_map(db)
+    kelas_ids = set(kelas_map.values())
+    rows = iter_rows(upload)
+    report = ImportReport()
+    seen_nis = set()
+
+    while True:
+        # File reads and XLSX parsing are blocking; keep them off the event loop
+        try:
+            chunk = await run_in_threadpool(_take, rows, CHUNK_SIZE)
+        except ImportFileError as e:
+            # Earlier chunks are already written; say how far the import got
+            raise HTTPException(status_code=400, detail={"message": str(e), **report.as_dict()})
+        if not chunk:
+            break
+
+        ops, row_numbers, niss = [], [], []
+        for row_number, raw in chunk:
+            report.total_rows += 1
+            nis = raw.get("nis")
+            kelas_name = raw.pop("kelas", None) or raw.pop("nama_kelas", None)
+            if not raw.get("kelas_id") and kelas_name:
+                raw["kelas_id"] = kelas_map.get(kelas_name.lower())
+                if raw["kelas_id"] is None:
+                    report.error(row_number, nis, f"Unknown kelas '{kelas_name}'")
+                    continue
+            elif raw.get("kelas_id") and raw["kelas_id"] not in kelas_ids:
+                report.error(row_number, nis, f"Unknown kelas_id '{raw.get('kelas_id')}'")
+                continue
+
+            raw.pop("id", None)
+            try:
+                siswa: BaseModel = model(**{k: v for k, v in raw.items() if v is not None})
+            except ValidationError as e:
+                message = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+                report.error(row_number, nis, message)
+                continue
+
+            if siswa.nis in seen_nis:
+                report.error(row_number, nis, "Duplicate NIS in file")
+                continue
+            seen_nis.add(siswa.nis)
+
+            # Columns missing from the file (e.g. foto) keep their stored value
+            fields = siswa.dict(exclude={"id", "version"}, exclude_unset=True)
+            if fields.get("foto"):
+                try:
+                    fields["foto"] = await store_inline(photo_store, fields["foto"])
+                except PhotoError as e:
+                    report.error(row_number, nis, f"foto: {e}")
+                    continue
+            fields.setdefault("is_active", True)
+            if fields["is_active"]:
+                fields.update(activity_fields(True))
+            ops.append(UpdateOne(
+                {"nis": siswa.nis},
+                {
+                    "$set": {**fields, **search.search_fields(fields)},
+                    "$setOnInsert": {"id": str(uuid.uuid4())},
+                    # An upsert creates the version at 1; updates invalidate existing ETags
+                    "$inc": {"version": 1},
+                },
+                upsert=True,
+            ))
+            row_numbers.append(row_number)
+            niss.append(siswa.nis)
+
+        if ops:
+            await _write(db, ops, row_numbers, niss, report)
+
+    return report.as_dict()
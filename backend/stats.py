@@ -0,0 +1,91 @@
+"""Materialized dashboard counters.
+
+A single document in the ``stats`` collection holds the totals shown on the
+dashboard plus active siswa per kelas. Write routes adjust it with ``$inc``;
+a periodic reconciliation recounts everything to correct any drift (e.g. from
+writes that bypassed the API). Reads go through a short in-process cache, so
+dashboard polling costs at most one small read per ``cache_ttl`` seconds.
+"""
+import asyncio
+import logging
+from typing import Any, Dict, Optional
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+STATS_DOC_ID = "dashboard"
+SISWA_BY_KELAS = "siswa_by_kelas"
+
+
+class DashboardCounters:
+    def __init__(self, cache_ttl: float = 10.0, reconcile_interval: float = 600.0):
+        self._cache = TTLCache(maxsize=1, ttl=cache_ttl)
+        self.reconcile_interval = reconcile_interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def get(self, db) -> Dict[str, Any]:
+        counters = self._cache.get(STATS_DOC_ID)
+        if counters is None:
+            counters = await db.stats.find_one({"_id": STATS_DOC_ID}, {"_id": 0})
+            if counters is None:
+                counters = await self.reconcile(db)
+            self._cache.set(STATS_DOC_ID, counters)
+        return counters
+
+    async def increment(self, db, deltas: Dict[str, int]):
+        deltas = {k: v for k, v in deltas.items() if v}
+        if not deltas:
+            return
+        await db.stats.update_one({"_id": STATS_DOC_ID}, {"$inc": deltas}, upsert=True)
+        self._cache.clear()
+
+    async def siswa_changed(self, db, before: Optional[Dict[str, Any]], after: Optional[Dict[str, Any]]):
+        """Apply the counter deltas for a siswa going from ``before`` to ``after``."""
+        deltas: Dict[str, int] = {}
+        for doc, sign in ((before, -1), (after, 1)):
+            if doc and doc.get("is_active", True):
+                deltas["siswa"] = deltas.get("siswa", 0) + sign
+                key = f"{SISWA_BY_KELAS}.{doc['kelas_id']}"
+                deltas[key] = deltas.get(key, 0) + sign
+        await self.increment(db, deltas)
+
+    async def kelas_deleted(self, db, kelas_id: str):
+        await db.stats.update_one(
+            {"_id": STATS_DOC_ID},
+            {"$inc": {"kelas": -1}, "$unset": {f"{SISWA_BY_KELAS}.{kelas_id}": ""}},
+            upsert=True,
+        )
+        self._cache.clear()
+
+    async def reconcile(self, db) -> Dict[str, Any]:
+        """Recount everything from the source collections and store the result."""
+        by_kelas = await db.siswa.aggregate([
+            {"$match": {"is_active": True}},
+            {"$group": {"_id": "$kelas_id", "n": {"$sum": 1}}},
+        ]).to_list(None)
+        counters = {
+            "siswa": sum(k["n"] for k in by_kelas),
+            "guru": await db.guru.count_documents({}),
+            "kelas": await db.kelas.count_documents({}),
+            "mapel": await db.mapel.count_documents({}),
+            SISWA_BY_KELAS: {k["_id"]: k["n"] for k in by_kelas if k["_id"]},
+        }
+        await db.stats.replace_one({"_id": STATS_DOC_ID}, counters, upsert=True)
+        self._cache.clear()
+        return counters
+
+    async def _reconcile_forever(self, db):
+        while True:
+            try:
+                await self.reconcile(db)
+            except Exception:
+                logger.exception("Dashboard counter reconciliation failed")
+            await asyncio.sleep(self.reconcile_interval)
+
+    def start(self, db):
+        self._task = asyncio.create_task(self._reconcile_forever(db))
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
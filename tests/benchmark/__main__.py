@@ -0,0 +1,266 @@
+"""Load benchmark for the E-Rapor API.
+
+Seeds a throwaway database, drives a weighted mix of login, dashboard, list,
+search, detail and update traffic through the ASGI app in-process, and reports
+p50/p95/p99 latency, throughput and Mongo commands per request for each route.
+
+    # against a local mongod (MONGO_URL, default mongodb://localhost:27017)
+    python -m tests.benchmark --siswa 20000 --concurrency 32 --requests 5000 \\
+        --output bench.json
+
+    # compare with a stored baseline; exits 1 on regression (for CI)
+    python -m tests.benchmark --baseline tests/benchmark/baseline.json
+
+    # no mongod available: use mongomock-motor as an in-process stand-in
+    # (no command counts, and $lookup-based routes are not supported by it)
+    python -m tests.benchmark --in-process --siswa 5000
+
+Run from the repository root.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+BACKEND_DIR = Path(__file__).resolve().parents[2] / "backend"
+
+DEFAULT_MIX = "login=1,dashboard=10,list=10,search=20,detail=15,update=5,kelas_detailed=2"
+
+_current_route: ContextVar[Optional[str]] = ContextVar("bench_route", default=None)
+
+
+class CommandCounter:
+    """pymongo listener attributing started commands to the route being driven."""
+
+    def __init__(self):
+        self.counts: Dict[str, int] = {}
+
+    def started(self, event):
+        route = _current_route.get()
+        if route is not None:
+            self.counts[route] = self.counts.get(route, 0) + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def parse_mix(spec: str) -> Dict[str, int]:
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = int(weight or 1)
+    return {k: v for k, v in mix.items() if v > 0}
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+class Scenario:
+    def __init__(self, client, dataset: Dict[str, List[Dict[str, Any]]], admin_headers, wali_headers, rng: random.Random):
+        self.client = client
+        self.rng = rng
+        self.admin_headers = admin_headers
+        self.wali_headers = wali_headers
+        self.siswa_ids = [s["id"] for s in dataset["siswa"] if s["is_active"]]
+        self.names = [s["nama_lengkap"] for s in dataset["siswa"]]
+        self.emails = [u["email"] for u in dataset["users"]]
+
+    async def login(self):
+        return await self.client.post("/api/auth/login", json={"email": self.rng.choice(self.emails), "password": "bench"})
+
+    async def dashboard(self):
+        headers = self.admin_headers if self.rng.random() < 0.3 else self.wali_headers
+        return await self.client.get("/api/dashboard/stats", headers=headers)
+
+    async def list(self):
+        return await self.client.get("/api/siswa", params={"limit": 100}, headers=self.admin_headers)
+
+    async def search(self):
+        # Search-as-you-type: a 2-5 character prefix of a real name
+        word = self.rng.choice(self.rng.choice(self.names).split())
+        q = word[: self.rng.randrange(2, 6)]
+        return await self.client.get("/api/siswa/search", params={"q": q, "limit": 20}, headers=self.admin_headers)
+
+    async def detail(self):
+        return await self.client.get(f"/api/siswa/{self.rng.choice(self.siswa_ids)}", headers=self.admin_headers)
+
+    async def update(self):
+        siswa_id = self.rng.choice(self.siswa_ids)
+        return await self.client.patch(f"/api/siswa/{siswa_id}", json={"tanggal_lahir": "2008-01-01"}, headers=self.admin_headers)
+
+    async def kelas_detailed(self):
+        return await self.client.get("/api/kelas/detailed", headers=self.admin_headers)
+
+
+async def run(args) -> Dict[str, Any]:
+    import httpx
+
+    os.environ.setdefault("BCRYPT_ROUNDS", str(args.bcrypt_rounds))
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+    from indexes import ensure_indexes
+    from search import search_fields
+
+    from tests.benchmark.data import build_dataset
+
+    counter = None
+    if args.in_process:
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            sys.exit("--in-process needs mongomock-motor (pip install mongomock-motor)")
+        client = AsyncMongoMockClient()
+    else:
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        counter = CommandCounter()
+        client = AsyncIOMotorClient(args.mongo_url, event_listeners=[counter])
+
+    db_name = f"erapor_bench_{uuid.uuid4().hex[:8]}"
+    db = client[db_name]
+    server.db = db
+    rng = random.Random(args.seed)
+
+    try:
+        print(f"Seeding {db_name}: {args.siswa} siswa, {args.users} users ...", file=sys.stderr)
+        password_hash = server.password_hasher.context.hash("bench")
+        dataset = build_dataset(rng, args.jurusan, args.kelas_per_jurusan, args.siswa, args.users, password_hash, search_fields)
+        for collection, docs in dataset.items():
+            for i in range(0, len(docs), 5000):
+                await db[collection].insert_many([dict(d) for d in docs[i:i + 5000]], ordered=False)
+        await ensure_indexes(db)
+        await server.dashboard_counters.reconcile(db)
+
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+            async def token_for(role):
+                email = next(u["email"] for u in dataset["users"] if u["role"] == role)
+                response = await http.post("/api/auth/login", json={"email": email, "password": "bench"})
+                response.raise_for_status()
+                return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+            scenario = Scenario(http, dataset, await token_for("admin"), await token_for("wali_kelas"), rng)
+            mix = parse_mix(args.mix)
+            routes, weights = list(mix), list(mix.values())
+            plan = rng.choices(routes, weights=weights, k=args.requests)
+            latencies: Dict[str, List[float]] = {r: [] for r in routes}
+            errors: Dict[str, int] = {r: 0 for r in routes}
+            if counter:
+                counter.counts.clear()
+
+            queue = iter(plan)
+
+            async def worker():
+                for route in queue:
+                    token = _current_route.set(route)
+                    started = time.perf_counter()
+                    try:
+                        response = await getattr(scenario, route)()
+                        if response.status_code >= 400:
+                            errors[route] += 1
+                    except Exception:
+                        errors[route] += 1
+                    finally:
+                        latencies[route].append(time.perf_counter() - started)
+                        _current_route.reset(token)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+            elapsed = time.perf_counter() - started
+    finally:
+        if not args.keep_db:
+            await client.drop_database(db_name)
+        client.close()
+
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(plan) / elapsed, 1),
+        "routes": {},
+    }
+    for route, values in latencies.items():
+        values.sort()
+        report["routes"][route] = {
+            "requests": len(values),
+            "errors": errors[route],
+            "p50_ms": round(percentile(values, 50) * 1000, 2),
+            "p95_ms": round(percentile(values, 95) * 1000, 2),
+            "p99_ms": round(percentile(values, 99) * 1000, 2),
+            "throughput_rps": round(len(values) / elapsed, 1),
+            "mongo_ops_per_request": round(counter.counts.get(route, 0) / len(values), 2) if counter and values else None,
+        }
+    return report
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Regressions of ``report`` against ``baseline``: slower p95 or more Mongo commands."""
+    regressions = []
+    for route, current in report["routes"].items():
+        previous = baseline.get("routes", {}).get(route)
+        if not previous:
+            continue
+        if current["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{route}: p95 {previous['p95_ms']} -> {current['p95_ms']} ms")
+        ops, previous_ops = current.get("mongo_ops_per_request"), previous.get("mongo_ops_per_request")
+        if ops is not None and previous_ops is not None and ops > previous_ops + 0.01:
+            regressions.append(f"{route}: mongo ops/request {previous_ops} -> {ops}")
+        if current["errors"] > previous.get("errors", 0):
+            regressions.append(f"{route}: errors {previous.get('errors', 0)} -> {current['errors']}")
+    return regressions
+
+
+def print_report(report: Dict[str, Any]):
+    print(f"{'route':<16}{'req':>7}{'err':>5}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'rps':>9}{'ops/req':>9}")
+    for route, r in report["routes"].items():
+        ops = "-" if r["mongo_ops_per_request"] is None else r["mongo_ops_per_request"]
+        print(f"{route:<16}{r['requests']:>7}{r['errors']:>5}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}{r['throughput_rps']:>9}{ops:>9}")
+    print(f"total: {report['throughput_rps']} req/s over {report['elapsed_s']} s")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m tests.benchmark", description=__doc__.splitlines()[0])
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--in-process", action="store_true", help="use mongomock-motor instead of a mongod")
+    parser.add_argument("--jurusan", type=int, default=4)
+    parser.add_argument("--kelas-per-jurusan", type=int, default=3)
+    parser.add_argument("--siswa", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"route=weight list (default: {DEFAULT_MIX})")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--bcrypt-rounds", type=int, default=12)
+    parser.add_argument("--keep-db", action="store_true")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--baseline", help="baseline JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p95 slowdown (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    if args.baseline:
+        regressions = compare(report, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+"""Realistic, reproducible seed data for the benchmark database."""
+import random
+import uuid
+from typing import Any, Dict, List
+
+FIRST_NAMES = [
+    "Muhammad", "Ahmad", "Rizky", "Budi", "Dimas", "Fajar", "Andi", "Bayu", "Eko", "Gilang",
+    "Siti", "Nur", "Putri", "Dewi", "Ayu", "Rina", "Fitri", "Indah", "Ratna", "Wulan",
+    "Agus", "Hendra", "Yoga", "Rafi", "Aditya", "Nabila", "Salsabila", "Anisa", "Citra", "Intan",
+]
+LAST_NAMES = [
+    "Pratama", "Saputra", "Wijaya", "Kurniawan", "Santoso", "Hidayat", "Setiawan", "Nugroho",
+    "Lestari", "Rahmawati", "Permata", "Anggraini", "Wahyuni", "Maharani", "Ramadhan", "Firmansyah",
+    "Siregar", "Nasution", "Simanjuntak", "Hakim", "Syahputra", "Kusuma", "Utami", "Purnomo",
+]
+TINGKATAN = ["X", "XI", "XII"]
+
+
+def _name(rng: random.Random) -> str:
+    parts = [rng.choice(FIRST_NAMES)]
+    if rng.random() < 0.6:
+        parts.append(rng.choice(FIRST_NAMES))
+    parts.append(rng.choice(LAST_NAMES))
+    return " ".join(parts)
+
+
+def build_dataset(rng: random.Random, jurusan: int, kelas_per_jurusan: int, siswa: int, users: int,
+                  password_hash: str, search_fields) -> Dict[str, List[Dict[str, Any]]]:
+    """Documents for every collection, shaped exactly as the API writes them."""
+    jurusan_docs = [
+        {"id": str(uuid.UUID(int=rng.getrandbits(128))), "kode_jurusan": f"J{j:02d}", "nama_jurusan": f"Jurusan {j:02d}"}
+        for j in range(jurusan)
+    ]
+    user_docs = [
+        {
+            "id": str(uuid.UUID(int=rng.getrandbits(128))),
+            "email": f"user{u}@bench.sch.id",
+            "name": _name(rng),
+            "role": "admin" if u == 0 else ("wali_kelas" if u % 3 else "guru_mapel"),
+            "is_active": True,
+            "password": password_hash,
+        }
+        for u in range(users)
+    ]
+    walis = [u["id"] for u in user_docs if u["role"] == "wali_kelas"]
+    kelas_docs = []
+    for j in jurusan_docs:
+        for tingkat in TINGKATAN:
+            for n in range(1, kelas_per_jurusan + 1):
+                kelas_docs.append({
+                    "id": str(uuid.UUID(int=rng.getrandbits(128))),
+                    "tingkatan": tingkat,
+                    "jurusan_id": j["id"],
+                    "nama_kelas": f"{tingkat} {j['kode_jurusan']} {n}",
+                    "wali_kelas_id": walis[len(kelas_docs) % len(walis)] if walis else None,
+                    "version": 0,
+                })
+    siswa_docs = []
+    for s in range(siswa):
+        doc = {
+            "id": str(uuid.UUID(int=rng.getrandbits(128))),
+            "nis": f"{20000 + s}",
+            "nisn": f"{rng.randrange(10**9, 10**10)}",
+            "nama_lengkap": _name(rng),
+            "jk": rng.choice("LP"),
+            "tanggal_lahir": f"20{rng.randrange(6, 10):02d}-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}",
+            "kelas_id": rng.choice(kelas_docs)["id"],
+            "foto": None,
+            "is_active": rng.random() > 0.05,
+            "version": 0,
+        }
+        doc.update(search_fields(doc))
+        siswa_docs.append(doc)
+    return {"jurusan": jurusan_docs, "kelas": kelas_docs, "users": user_docs, "siswa": siswa_docs}